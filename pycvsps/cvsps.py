@@ -5,14 +5,24 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2 or any later version.
 
+import bisect
+import calendar
+import concurrent.futures
 import functools
+import hashlib
+import itertools
+import mmap
 import os
 import os.path
 import pickle
+import queue
 import re
 import subprocess
 import sys
+import tempfile
+import threading
 from optparse import OptionParser, SUPPRESS_HELP
+from . import logstore, rcsfile, sqlcache
 from .dateutil import datestr, parsedate
 
 def ellipsis(text, maxlength=400):
@@ -28,7 +38,8 @@ class logentry(object):
     '''Class logentry has the following attributes:
         .author    - author name as CVS knows it
         .branch    - name of branch this revision is on
-        .branches  - revision tuple of branches starting at this revision
+        .branches  - tuple of revision tuples of branches starting at this
+                     revision
         .comment   - commit message
         .commitid  - CVS commitid or None
         .date      - the commit date as a (time, tz) tuple
@@ -38,26 +49,67 @@ class logentry(object):
         .parent    - Previous revision of this entry
         .rcs       - name of file as returned from CVS
         .revision  - revision number as tuple
-        .tags      - list of tags on the file
+        .tags      - tuple of tags on the file
         .synthetic - is this a synthetic "file ... added on ..." revision?
         .mergepoint - the branch that has been merged from (if present in
                       rlog output) or None
-        .branchpoints - the branches that start at the current entry or empty
+        .branchpoints - frozenset of the branches that start at the current
+                        entry
     '''
+    __slots__ = ('author', 'branch', 'branches', 'branchpoints', 'comment',
+                 'commitid', 'date', 'dead', 'file', 'lines', 'mergepoint',
+                 'parent', 'rcs', 'revision', 'synthetic', 'tags')
+
     def __init__(self, **entries):
         self.synthetic = False
-        self.__dict__.update(entries)
+        for k, v in entries.items():
+            setattr(self, k, v)
+
+    def __getstate__(self):
+        '''Return the fields in slot order, None for those never set
+
+        >>> e = logentry(file='a.c', revision=(1, 2))
+        >>> e.__getstate__()[8:10] + e.__getstate__()[13:15]
+        ('a.c', None, (1, 2), False)
+        >>> f = pickle.loads(pickle.dumps(e))
+        >>> (f.file, f.revision, f.synthetic, f.author)
+        ('a.c', (1, 2), False, None)
+        '''
+        return tuple(getattr(self, k, None) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
 
     def __repr__(self):
-        items = ("%s=%r"%(k, self.__dict__[k]) for k in sorted(self.__dict__))
+        items = ("%s=%r"%(k, getattr(self, k)) for k in sorted(self.__slots__)
+                 if hasattr(self, k))
         return "%s(%s)"%(type(self).__name__, ", ".join(items))
 
 class logerror(Exception):
     pass
 
+# Written at the start of the log cache index; change the version whenever
+# the cache layout or the pickled form of logentry changes, so that old
+# caches are rebuilt.
+_cachemagic = b'pycvsps log cache 5\n'
+
+# Written at the start of the changeset cache; change the version whenever
+# createchangeset() gives different results for the same log.
+_changesetmagic = b'pycvsps changesets 5\n'
+
+# number of cache segments at which they are merged into one
+_maxsegments = 8
+
+_nobranches = frozenset()
+
 def parse_revision(revision):
     return tuple(map(int, revision.split('.')))
 
+# The same revision numbers occur in many files; remember recently parsed
+# ones, which also lets equal revisions share one tuple.
+_revision = functools.lru_cache(maxsize=4096)(parse_revision)
+
 def getrepopath(cvspath):
     """Return the repository path from a CVS path.
 
@@ -126,41 +178,785 @@ def build_prefix(root, repository):
         prefix = repository
     return prefix + os.sep
 
-def createlog(ui, directory=None, root="", rlog=True, cache=None):
-    '''Collect the CVS rlog'''
+file_added_re = re.compile(r'file [^/]+ was (initially )?added on branch')
 
-    # Because we store many duplicate commit log messages, reusing strings
-    # saves a lot of memory and pickle storage space.
+def _addsymbol(tags, branchmap, name, revision):
+    '''Record a symbolic name of the current file in tags and branchmap'''
+    rev = _revision(revision)
+
+    # Convert magic branch number to an odd-numbered one
+    revn = len(rev)
+    if revn > 3 and (revn % 2) == 0 and rev[-2] == 0:
+        rev = rev[:-2] + rev[-1:]
+
+    if rev not in tags:
+        tags[rev] = []
+    tags[rev].append(name)
+    branchmap[name] = revision
+
+class _branchindex(object):
+    '''Index of the branch names of one file, built once from its
+    branchmap so that branches can be looked up by revision.
+
+    .names     - mapping from magic branch number to branch names
+    .roots     - mapping from revision tuple to the names of the
+                 branches starting at that revision
+    .vendor    - names of the vendor branch 1.1.1
+    '''
+    def __init__(self, branchmap):
+        self.names = {}
+        self.roots = {}
+        self.vendor = set()
+        for branch, revision in branchmap.items():
+            self.names.setdefault(revision, []).append(branch)
+            revparts = parse_revision(revision)
+            if len(revparts) < 2: # bad tags
+                continue
+            if revparts[-2] == 0 and revparts[-1] % 2 == 0:
+                # normal branch
+                self.roots.setdefault(revparts[:-2], set()).add(branch)
+            elif revparts == (1, 1, 1): # vendor branch
+                self.vendor.add(branch)
+        # entries starting the same branches share one frozenset
+        for rev, names in self.roots.items():
+            self.roots[rev] = frozenset(names)
+        self.vendor = frozenset(self.vendor)
+
+    def branchpoints(self, e):
+        '''Return the frozenset of branches starting from entry e'''
+        branchpoints = self.roots.get(e.revision, _nobranches)
+        if self.vendor and (1, 1, 1) in e.branches:
+            branchpoints = branchpoints | self.vendor
+        return branchpoints
+
+def _mergepoint(branches, revision):
+    '''Return the name of the branch of a cvsnt mergepoint revision'''
+    myrev = revision.split('.')
+    if len(myrev) == 2: # head
+        return 'HEAD'
+    myrev = '.'.join(myrev[:-2] + ['0', myrev[-2]])
+    names = branches.names.get(myrev, [])
+    assert len(names) == 1, ('unknown branch: %s' % revision)
+    return names[0]
+
+def _storeentry(ui, e, tags, branches, scache):
+    '''Fill in the fields of e derived from the symbolic names and
+    comment of its file'''
+
+    # When a file is added on a branch B1, CVS creates a synthetic
+    # dead trunk revision 1.1 so that the branch has a root.
+    # Likewise, if you merge such a file to a later branch B2 (one
+    # that already existed when the file was added on B1), CVS
+    # creates a synthetic dead revision 1.1.x.1 on B2.  Don't drop
+    # these revisions now, but mark them synthetic so
+    # createchangeset() can take care of them.
+    if (e.dead and
+          e.revision[-1] == 1 and      # 1.1 or 1.1.x.1
+          '\n' not in e.comment and
+          file_added_re.match(e.comment)):
+        ui.debug('found synthetic revision in %s: %r\n'
+                 % (e.rcs, e.comment))
+        e.synthetic = True
+
+    e.tags = tuple(sorted([scache(x) for x in tags.get(e.revision, [])]))
+
+    revn = len(e.revision)
+    if revn > 3 and (revn % 2) == 0:
+        e.branch = tags.get(e.revision[:-1], [None])[0]
+    else:
+        e.branch = None
+
+    # find the branches starting from this revision
+    e.branchpoints = branches.branchpoints(e)
+
+def _localroot(root):
+    '''Return the repository path of a local CVSROOT, or None
+
+    >>> _localroot('/cvsroot')
+    '/cvsroot'
+    >>> _localroot(':local:/cvsroot')
+    '/cvsroot'
+    >>> _localroot(':pserver:anon@cvs.example.org:/cvsroot') is None
+    True
+    >>> _localroot('relative/path') is None
+    True
+    '''
+    if root.startswith(':local:'):
+        return root[len(':local:'):]
+    if root.startswith(':') or not os.path.isabs(root):
+        return None
+    return root
+
+def _rcsfiles(prefix):
+    '''Yield the paths of the RCS files below prefix'''
+    if not os.path.isdir(prefix):
+        raise logerror(_('there is no repository %s') % prefix)
+    for dirpath, dirnames, filenames in os.walk(prefix):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.endswith(',v'):
+                yield os.path.join(dirpath, name)
+
+def _rcsstats(prefix):
+    '''Return a dict mapping the path of each RCS file below prefix to
+    its (mtime, size, inode)
+
+    >>> import tempfile
+    >>> prefix = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(prefix, 'Attic'))
+    >>> for name in ('a.c,v', 'Attic/b.c,v', 'notes.txt'):
+    ...     with open(os.path.join(prefix, name), 'w') as fp:
+    ...         fp.write(name) and None
+    >>> stats = _rcsstats(prefix)
+    >>> sorted((os.path.relpath(rcs, prefix), st[1])
+    ...        for rcs, st in stats.items())
+    [('Attic/b.c,v', 11), ('a.c,v', 5)]
+    >>> with open(os.path.join(prefix, 'a.c,v'), 'a') as fp:
+    ...     fp.write('more') and None
+    >>> [os.path.relpath(rcs, prefix) for rcs, st in _rcsstats(prefix).items()
+    ...  if stats[rcs] != st]
+    ['a.c,v']
+    >>> import shutil
+    >>> shutil.rmtree(prefix)
+    '''
+    stats = {}
+    for rcs in _rcsfiles(prefix):
+        try:
+            st = os.stat(rcs)
+        except OSError as inst:
+            raise logerror(_('%s: %s') % (rcs, inst.strerror))
+        stats[rcs] = (st.st_mtime_ns, st.st_size, st.st_ino)
+    return stats
+
+def _rcsentries(ui, prefix, since, scache, files=None):
+    '''Read the RCS files below prefix, or only those in files, and
+    yield a logentry for each revision committed after since, as cvs
+    rlog would report them'''
+    if files is None:
+        files = _rcsfiles(prefix)
+    for rcs in files:
+        try:
+            rf = rcsfile.read(rcs)
+        except (IOError, rcsfile.rcserror) as inst:
+            raise logerror(_('%s: %s') % (rcs, inst))
+        filename = rcs_path(os.path.normpath(rcs[:-2])[len(prefix):])
+
+        tags = {}
+        branchmap = {}
+        for sym, revision in rf.symbols:
+            _addsymbol(tags, branchmap, sym, revision)
+        branches = _branchindex(branchmap)
+
+        for d in rf.deltas:
+            if since is not None and d.date <= since:
+                continue
+            e = logentry(rcs=scache(rcs),
+                         file=scache(filename),
+                         revision=_revision(d.revision),
+                         branches=tuple(_revision(b)[:-1]
+                                        for b in d.branches),
+                         parent=None,
+                         commitid=d.commitid,
+                         mergepoint=None,
+                         branchpoints=_nobranches)
+            e.date = (d.date, 0)
+            e.author = scache(d.author)
+            e.dead = d.state.lower() == 'dead'
+            # rlog counts the changed lines from the revision texts,
+            # which are not read
+            e.lines = None
+            if d.mergepoint:
+                e.mergepoint = _mergepoint(branches, d.mergepoint)
+
+            # rlog prints the message without its trailing newline
+            comment = d.log
+            if comment.endswith('\n'):
+                comment = comment[:-1]
+            elif not comment:
+                comment = '*** empty log message ***'
+            e.comment = scache(comment)
+
+            _storeentry(ui, e, tags, branches, scache)
+            yield e
+
+class _quietui(object):
+    '''ui for worker processes, which discards all messages'''
+    def nomessage(self, msg):
+        pass
+
+    status = nomessage
+    note = nomessage
+    debug = nomessage
+    warn = nomessage
+    write = nomessage
+
+# access methods that talk to a cvs server over the network, where it
+# pays off to compress the (r)log output
+_remotemethods = ('ext', 'extssh', 'gserver', 'kserver', 'pserver',
+                  'server', 'ssh', 'sspi')
+
+def _compression(root, level):
+    '''Return the cvs -z compression level to use for root: level if
+    it is not None, else 3 for remote and 0 for local repositories
+
+    >>> _compression('/cvsroot', None), _compression(':fork:/cvsroot', None)
+    (0, 0)
+    >>> _compression(':pserver:anon@cvs.example.org:/cvsroot', None)
+    3
+    >>> _compression('me@host:/cvsroot', None)
+    3
+    >>> _compression(':ext;CVS_RSH=ssh:host:/cvsroot', None)
+    3
+    >>> _compression(':pserver:host:/cvsroot', 0), _compression('/cvsroot', 9)
+    (0, 9)
+    '''
+    if level is not None:
+        return level
+    if root.startswith(':'):
+        method = root[1:].split(':', 1)[0].split(';', 1)[0]
+    elif ':' in root:
+        # [user@]host:/path is the ext method
+        method = 'ext'
+    else:
+        method = 'local'
+    if method in _remotemethods:
+        return 3
+    return 0
+
+def _cvscmd(root, compression):
+    '''Return the start of a cvs command line for root'''
+    cmd = ['cvs', '-q']
+    if compression:
+        cmd.append('-z%d' % compression)
+    if root:
+        cmd.append('-d%s' % root)
+    return cmd
+
+def _logcmd(root, rlog, date, directory, local=False, compression=0,
+            skipunchanged=False):
+    '''Build the cvs (r)log command line for directory.
+
+    If skipunchanged is true, files without revisions after date are
+    left out of the output; this needs cvs 1.12 or CVSNT on the server.
+    '''
+    cmd = _cvscmd(root, compression)
+    cmd.append(['log', 'rlog'][rlog])
+    if local:
+        cmd.append('-l')
+    if date:
+        if skipunchanged:
+            # the headers and symbolic names of files without new
+            # revisions are of no use for an update
+            cmd.append('-S')
+        # no space between option and date string
+        cmd.append('-d>%s' % date)
+    cmd.append(directory)
+    return cmd
+
+def _subdirectories(ui, root, directory, compression=0):
+    '''Return the names of the subdirectories of directory in the
+    repository, or None if they cannot be listed'''
+    path = _localroot(root)
+    if path is not None:
+        path = os.path.join(path, directory)
+        try:
+            return sorted(d.name for d in os.scandir(path)
+                          if d.is_dir() and d.name not in ('Attic', 'CVS'))
+        except OSError as inst:
+            ui.note(_('cannot list %s: %s\n') % (path, inst))
+            return None
+
+    cmd = _cvscmd(root, compression) + ['rls', '-e', directory]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE)
+    except OSError as inst:
+        ui.note(_('cannot run %s: %s\n') % (' '.join(cmd), inst))
+        return None
+    if p.returncode:
+        ui.note(_('%s failed\n') % ' '.join(cmd))
+        return None
+    subdirs = []
+    for line in p.stdout.decode('latin-1').splitlines():
+        # directories are listed as D/name////
+        if line.startswith('D/'):
+            subdirs.append(line.split('/')[1])
+    return sorted(subdirs)
+
+def _rlogjob(cmd, rlog, prefix, pipeline):
+    '''Collect the log entries of one cvs (r)log command in a worker'''
     _scache = {}
     def scache(s):
-        "return a shared version of a string"
         return _scache.setdefault(s, s)
+    return list(_rlogentries(_quietui(), cmd, rlog, prefix, scache,
+                             pipeline))
+
+def _parallelentries(ui, root, directory, date, prefix, jobs, compression,
+                     scache, pipeline=False, skipunchanged=False):
+    '''Run one cvs rlog per subdirectory of directory, up to jobs at
+    once, and yield the logentry objects they report'''
+    subdirs = _subdirectories(ui, root, directory, compression)
+    if not subdirs:
+        cmd = _logcmd(root, True, date, directory, compression=compression,
+                      skipunchanged=skipunchanged)
+        ui.note(_("running %s\n") % (' '.join(cmd)))
+        for e in _rlogentries(ui, cmd, True, prefix, scache, pipeline):
+            yield e
+        return
 
-    ui.status(_('collecting CVS rlog\n'))
+    # the files directly in directory (and its Attic), then one job
+    # for each subdirectory tree
+    cmds = [_logcmd(root, True, date, directory, local=True,
+                    compression=compression, skipunchanged=skipunchanged)]
+    for d in subdirs:
+        cmds.append(_logcmd(root, True, date, os.path.join(directory, d),
+                            compression=compression,
+                            skipunchanged=skipunchanged))
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = []
+        for cmd in cmds:
+            ui.note(_("running %s\n") % (' '.join(cmd)))
+            futures.append(pool.submit(_rlogjob, cmd, True, prefix,
+                                       pipeline))
+        for future in futures:
+            for e in future.result():
+                # share strings with the entries of the other jobs
+                e.rcs = scache(e.rcs)
+                e.file = scache(e.file)
+                e.author = scache(e.author)
+                e.comment = scache(e.comment)
+                e.tags = tuple(scache(x) for x in e.tags)
+                yield e
+
+# patterns to match in CVS (r)log output
+re_01 = re.compile(br'cvs \[r?log aborted\]: (.+)$')
+re_02 = re.compile(br'cvs (r?log|server): (.+)\n$')
+re_03 = re.compile(br"(Cannot access.+CVSROOT)|"
+                   br"(can't create temporary directory.+)$")
+re_rcsfile = re.compile(br'^RCS file: (.+)$', re.M)
+re_workfile = re.compile(br'\nWorking file: (.+)$', re.M)
+re_symbols = re.compile(br'^symbolic names:\n((?:\t.*\n)*)', re.M)
+re_symbol = re.compile(br'\t(.+): ([\d.]+)$', re.M)
+re_revsep = re.compile(br'\n----------------------------\n'
+                       br'(?=revision [\d.]+(?:[ \t]+locked by:[ \t]+.+;)?$)',
+                       re.M)
+re_revision = re.compile(br'revision ([\d.]+)([ \t]+locked by:[ \t]+.+;)?\n'
+                         br'date:[ \t]+(.+);[ \t]+author:[ \t]+(.+);'
+                         br'[ \t]+state:[ \t]+(.+?);'
+                         br'([ \t]+lines:[ \t]+(\+\d+)?[ \t]+(-\d+)?;)?'
+                         br'([ \t]+commitid:[ \t]+([^;\n]+);)?'
+                         br'(.*mergepoint:[ \t]+([^;\n]+);)?'
+                         br'.*(?:\n|\Z)'
+                         br'(branches: (.+);(?:\n|\Z))?')
+
+re_date = re.compile(br'(\d\d|\d{4})([/-])(\d\d)\2(\d\d)'
+                     br' (\d\d):(\d\d):(\d\d)(?: ([+-])(\d\d)(\d\d))?$')
+
+filesep = b'\n' + b'=' * 77 + b'\n'
+
+def _readchunks(fp, size=1 << 20):
+    '''Yield the data read from fp in chunks of up to size bytes'''
+    while True:
+        chunk = fp.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+def _pipedchunks(ui, fp, depth=8):
+    '''Yield the data read from fp in chunks, which a separate thread
+    reads ahead, up to depth chunks, so that the process writing to fp
+    is not stalled while the chunks are parsed'''
+    chunks = queue.Queue(depth)
+    done = threading.Event()
+    stats = {'chunks': 0, 'depth': 0, 'empty': 0, 'full': 0}
+
+    def reader():
+        try:
+            for chunk in _readchunks(fp):
+                if chunks.full():
+                    stats['full'] += 1
+                chunks.put(chunk)
+                if done.is_set():
+                    return
+        except Exception as inst:
+            chunks.put(inst)
+        else:
+            chunks.put(None)
+
+    thread = threading.Thread(target=reader, name='cvs log reader')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            if chunks.empty():
+                stats['empty'] += 1
+            stats['depth'] += chunks.qsize()
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            stats['chunks'] += 1
+            yield chunk
+    finally:
+        # let the reader finish if the output was not read to the end
+        done.set()
+        while not chunks.empty():
+            chunks.get_nowait()
+
+    # a queue that is often empty means cvs is the bottleneck, one that
+    # is often full means that parsing is
+    n = max(stats['chunks'], 1)
+    ui.status(_('read %d chunks of cvs output, average queue depth %.1f; '
+                'queue empty %d times (%d%%, waiting for cvs), '
+                'full %d times (%d%%, waiting for the parser)\n')
+              % (stats['chunks'], stats['depth'] / n,
+                 stats['empty'], 100 * stats['empty'] // n,
+                 stats['full'], 100 * stats['full'] // n))
+
+def _records(chunks):
+    '''Split (r)log output into the records of individual files'''
+    buf = bytearray()
+    scan = 0
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(filesep, scan)
+            if end < 0:
+                break
+            yield bytes(buf[start:end])
+            start = scan = end + len(filesep)
+        del buf[:start]
+        # the separator may straddle two chunks
+        scan = max(0, len(buf) - len(filesep) + 1)
+    if buf:
+        yield bytes(buf)
+
+def _maprecords(data):
+    '''Split (r)log output held in one buffer, such as an mmap, into
+    the records of individual files without copying it as a whole'''
+    start = 0
+    while True:
+        end = data.find(filesep, start)
+        if end < 0:
+            break
+        yield data[start:end]
+        start = end + len(filesep)
+    if start < len(data):
+        yield data[start:]
+
+# all revisions of one commit have the same date
+@functools.lru_cache(maxsize=1024)
+def _logdate(text):
+    '''Parse the date of a revision in cvs (r)log output and return a
+    (unixtime, offset) tuple
+
+    >>> _logdate(b'1998/12/02 00:00:05')
+    (912556805, 0)
+    >>> _logdate(b'98/12/02 00:00:05')
+    (912556805, 0)
+    >>> _logdate(b'2004-03-01 10:00:00 +0100')
+    (1078131600, -3600)
+    >>> _logdate(b'2004-03-01 10:00:00 -0500')
+    (1078153200, 18000)
+    '''
+    match = re_date.match(text)
+    if match:
+        (year, sep, month, day, hour, minute, second,
+         sign, tzh, tzm) = match.groups()
+        year, month, day = int(year), int(month), int(day)
+        if year < 100 and sep == b'/':
+            # Y2K
+            year += 1900
+        if (year >= 1000 and 1 <= month <= 12 and
+            1 <= day <= calendar.monthrange(year, month)[1] and
+            int(hour) < 24 and int(minute) < 60 and int(second) < 62):
+            # cvs log dates without a time zone are always in GMT
+            offset = 0
+            if sign:
+                offset = (int(tzh) * 60 + int(tzm)) * 60
+                if sign == b'+':
+                    offset = -offset
+            when = calendar.timegm((year, month, day, int(hour),
+                                    int(minute), int(second))) + offset
+            if (-0x80000000 <= when <= 0x7fffffff and
+                -50400 <= offset <= 43200):
+                return when, offset
+
+    # anything unusual is left to the generic parser
+    d = text.decode('latin-1')
+    if d[2] == '/':
+        # Y2K
+        d = '19' + d
+
+    if len(d.split()) != 3:
+        # cvs log dates always in GMT
+        d = d + ' UTC'
+    return parsedate(d, ['%y/%m/%d %H:%M:%S',
+                         '%Y/%m/%d %H:%M:%S',
+                         '%Y-%m-%d %H:%M:%S'])
+
+def _checkerrors(text):
+    '''Raise logerror for error messages of cvs found in text'''
+    for line in text.splitlines():
+        match = re_01.match(line)
+        if match:
+            raise logerror(match.group(1).decode('latin-1'))
+        match = re_02.match(line)
+        if match:
+            raise logerror(match.group(2).decode('latin-1'))
+        if re_03.match(line):
+            raise logerror(line.decode('latin-1'))
+
+def _parselog(ui, records, rlog, prefix, scache):
+    '''Parse the file records of cvs (r)log output and yield a logentry
+    for each revision they report'''
+
+    # decode each distinct author and comment only once
+    _dcache = {}
+    def decode(s):
+        d = _dcache.get(s)
+        if d is None:
+            d = _dcache[s] = scache(s.decode('latin-1'))
+        return d
+
+    for record in records:
+        match = re_rcsfile.search(record)
+        if not match:
+            # output outside of file records, e.g. error messages
+            _checkerrors(record)
+            continue
+        if match.start():
+            _checkerrors(record[:match.start()])
+        rcs = match.group(1).decode('latin-1')
+        pos = match.end()
+
+        if rlog:
+            filename = os.path.normpath(rcs[:-2])
+            if not filename.startswith(prefix):
+                continue
+            filename = rcs_path(filename[len(prefix):])
+        else:
+            # expect 'Working file' (only when using log instead of rlog)
+            match = re_workfile.match(record, pos)
+            assert match, _('RCS file must be followed by working file')
+            filename = os.path.normpath(match.group(1).decode('latin-1'))
+            pos = match.end()
+
+        # read the symbolic names and store as tags
+        match = re_symbols.search(record, pos)
+        if not match:
+            continue
+        tags = {}     # dictionary of revisions on current file with their tags
+        branchmap = {} # mapping between branch names and revision numbers
+        for m in re_symbol.finditer(match.group(1)):
+            _addsymbol(tags, branchmap, m.group(1).decode('latin-1'),
+                       m.group(2).decode('ascii'))
+        branches = _branchindex(branchmap)
+
+        # the header is followed by the revisions, each introduced by a
+        # '------' separator line
+        blocks = re_revsep.split(record[match.end():])
+        for block in blocks[1:]:
+            match = re_revision.match(block)
+            assert match, _('revision must be followed by date line')
+            e = logentry(rcs=scache(rcs),
+                         file=scache(filename),
+                         revision=_revision(match.group(1).decode('ascii')),
+                         branches=(),
+                         parent=None,
+                         commitid=None,
+                         mergepoint=None,
+                         branchpoints=_nobranches)
+
+            e.date = _logdate(match.group(3))
+            e.author = decode(match.group(4))
+            e.dead = match.group(5).lower() == b'dead'
 
-    log = []      # list of logentry objects containing the CVS state
-
-    # patterns to match in CVS (r)log output, by state of use
-    re_00 = re.compile(r'RCS file: (.+)$')
-    re_01 = re.compile(r'cvs \[r?log aborted\]: (.+)$')
-    re_02 = re.compile(r'cvs (r?log|server): (.+)\n$')
-    re_03 = re.compile(r"(Cannot access.+CVSROOT)|"
-                       r"(can't create temporary directory.+)$")
-    re_10 = re.compile(r'Working file: (.+)$')
-    re_20 = re.compile(r'symbolic names:')
-    re_30 = re.compile(r'\t(.+): ([\d.]+)$')
-    re_31 = re.compile(r'----------------------------$')
-    re_32 = re.compile(r'======================================='
-                       r'======================================$')
-    re_50 = re.compile(r'revision ([\d.]+)(\s+locked by:\s+.+;)?$')
-    re_60 = re.compile(r'date:\s+(.+);\s+author:\s+(.+);\s+state:\s+(.+?);'
-                       r'(\s+lines:\s+(\+\d+)?\s+(-\d+)?;)?'
-                       r'(\s+commitid:\s+([^;]+);)?'
-                       r'(.*mergepoint:\s+([^;]+);)?')
-    re_70 = re.compile(r'branches: (.+);$')
-
-    file_added_re = re.compile(r'file [^/]+ was (initially )?added on branch')
+            if match.group(7):
+                if match.group(8):
+                    e.lines = (int(match.group(7)), int(match.group(8)))
+                else:
+                    e.lines = (int(match.group(7)), 0)
+            elif match.group(8):
+                e.lines = (0, int(match.group(8)))
+            else:
+                e.lines = None
+
+            if match.group(9): # cvs 1.12 commitid
+                e.commitid = match.group(10).decode('latin-1')
+
+            if match.group(11): # cvsnt mergepoint
+                e.mergepoint = _mergepoint(branches,
+                                           match.group(12).decode('ascii'))
+
+            # read the revision numbers of branches that start at this
+            # revision
+            if match.group(13):
+                e.branches = tuple(
+                    _revision(x.strip().decode('ascii'))
+                    for x in match.group(14).split(b';')
+                )
+
+            # the rest of the block is the commit log message
+            e.comment = decode(block[match.end():])
+
+            _storeentry(ui, e, tags, branches, scache)
+            yield e
+
+def _rlogentries(ui, cmd, rlog, prefix, scache, pipeline=False):
+    '''Run cvs (r)log and yield a logentry for each revision it reports
 
+    If pipeline is true, the output of cvs is read by a separate thread
+    while it is parsed.
+    '''
+    # errors go to a file, so that cvs cannot block on a full pipe
+    with tempfile.TemporaryFile() as errors:
+        pfp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+        with pfp:
+            if pipeline:
+                chunks = _pipedchunks(ui, pfp.stdout)
+            else:
+                chunks = _readchunks(pfp.stdout)
+            records = _records(chunks)
+            for e in _parselog(ui, records, rlog, prefix, scache):
+                yield e
+        errors.seek(0)
+        text = errors.read().decode('latin-1')
+        if pfp.returncode:
+            # e.g. an option the server does not know; whatever was read
+            # is not the complete log
+            raise logerror(_('%s failed: %s')
+                           % (' '.join(cmd), text.strip() or
+                              _('exit status %d') % pfp.returncode))
+        if text:
+            ui.warn(text)
+
+def _replayentries(ui, path, rlog, prefix, scache):
+    '''Yield a logentry for each revision in the saved cvs (r)log
+    output in the file at path, or on stdin if path is -'''
+    if path == '-':
+        records = _records(_readchunks(sys.stdin.buffer))
+        for e in _parselog(ui, records, rlog, prefix, scache):
+            yield e
+        return
+
+    try:
+        fp = open(path, 'rb')
+    except IOError as e:
+        raise logerror(_('cannot read %s: %s') % (path, e.strerror))
+    with fp:
+        if not os.fstat(fp.fileno()).st_size:
+            # empty files cannot be mapped
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for e in _parselog(ui, _maprecords(data), rlog, prefix, scache):
+                yield e
+
+def _readcache(cachefile):
+    '''Read the log cache whose index is cachefile and return its log,
+    the RCS file stats, the latest revision on each branch of each file
+    and the names of its segments.
+
+    The index lists the segment files in order. Each holds a pickled
+    part of the log, and the stats and branch revisions that changed
+    with it.
+    '''
+    with open(cachefile, 'rb') as fp:
+        if fp.read(len(_cachemagic)) != _cachemagic:
+            raise logerror(_('cache was written in an older format'))
+        segments = pickle.load(fp)
+    cachedir = os.path.dirname(cachefile)
+    log = []
+    stats = {}
+    versions = {}
+    for i, name in enumerate(segments):
+        with open(os.path.join(cachedir, name), 'rb') as fp:
+            entries, newstats, newversions = pickle.load(fp)
+        if i:
+            log += entries
+        else:
+            log = entries
+        stats.update(newstats)
+        versions.update(newversions)
+    return log, stats, versions, segments
+
+def _writecache(ui, cachefile, segments, entries, stats, versions, compact):
+    '''Write entries, with the stats and branch revisions that changed,
+    to a new segment of the log cache, after the existing segments, or
+    in place of all of them if compact is true.
+    Return the new list of segments.'''
+    cachedir = os.path.dirname(cachefile)
+    base = os.path.basename(cachefile)
+
+    # a new segment never has the name of one that an index, maybe
+    # being read at this moment, refers to
+    segre = re.compile(re.escape(base) + r'\.(\d+)$')
+    numbers = [int(m.group(1)) for m in map(segre.match, os.listdir(cachedir))
+               if m]
+    name = '%s.%d' % (base, max(numbers, default=-1) + 1)
+    if segments and not compact:
+        segments = segments + [name]
+    else:
+        compact = True
+        segments = [name]
+
+    ui.note(_('writing cvs log cache segment %s\n') % name)
+    with open(os.path.join(cachedir, name), 'wb') as fp:
+        pickle.dump((entries, stats, versions), fp)
+
+    # replace the index in one step, so that it never refers to a
+    # segment that is not completely written
+    ui.note(_('writing cvs log cache %s\n') % cachefile)
+    with open(cachefile + '.tmp', 'wb') as fp:
+        fp.write(_cachemagic)
+        pickle.dump(segments, fp)
+    os.replace(cachefile + '.tmp', cachefile)
+
+    if compact:
+        for f in os.listdir(cachedir):
+            if segre.match(f) and f != name:
+                os.unlink(os.path.join(cachedir, f))
+    return segments
+
+def _aslog(entries, columnar):
+    '''Return entries, which may have been cached by a run with or
+    without columnar, in the container createlog() returns: a logstore
+    if columnar is true, else a list of logentry objects'''
+    if columnar:
+        if isinstance(entries, logstore.logstore):
+            return entries
+        return logstore.logstore(entries)
+    if (isinstance(entries, list) and
+        all(type(e) is logentry for e in entries)):
+        return entries
+    return [e if type(e) is logentry else
+            logentry(**dict((k, getattr(e, k)) for k in logentry.__slots__))
+            for e in entries]
+
+def _cachefile(root, directory):
+    '''Return the path of the log cache of directory in root'''
+    cachedir = os.path.expanduser('~/.pycvsps')
+    if not os.path.exists(cachedir):
+        os.mkdir(cachedir)
+
+    # The cvsps cache pickle needs a uniquified name, based on the
+    # repository location. The address may have all sort of nasties
+    # in it, slashes, colons and such. So here we take just the
+    # alphanumeric characters, concatenated in a way that does not
+    # mix up the various components, so that
+    #    :pserver:user@server:/path
+    # and
+    #    /pserver/user/server/path
+    # are mapped to different cache file names.
+    cachefile = root.split(":") + [directory, "cache"]
+    cachefile = ['-'.join(re.findall(r'\w+', s)) for s in cachefile if s]
+    return os.path.join(cachedir, '.'.join([s for s in cachefile if s]))
+
+def _sandbox(directory, root):
+    '''Return the repository directory and CVSROOT to read, taking them
+    from the CVS sandbox in the current directory if directory is None'''
     if directory is None:
         # Current working directory
 
@@ -181,325 +977,301 @@ def createlog(ui, directory=None, root="", rlog=True, cache=None):
     if not root:
         root = os.environ.get('CVSROOT', '')
 
+    return directory, root
+
+def _logentries(ui, root, directory, rlog, since, native, jobs, rlogfile,
+                compression, scache, files=None, pipeline=False,
+                skipunchanged=False):
+    '''Return an iterator over the logentry objects of directory, as
+    reported after since, a (time, tz) tuple or None
+
+    When reading RCS files directly, files may limit the RCS files read.
+    '''
+    prefix = build_prefix(root, directory)
+    ui.debug("prefix=%r directory=%r root=%r\n" % (prefix, directory, root))
+
+    if rlogfile is not None:
+        ui.note(_("reading cvs log from %s\n") % rlogfile)
+        return _replayentries(ui, rlogfile, rlog, prefix, scache)
+
+    if native:
+        if not rlog or _localroot(root) is None:
+            raise logerror(_('reading RCS files directly requires a local '
+                             'CVSROOT'))
+        ui.note(_("reading RCS files in %s\n") % prefix)
+        return _rcsentries(ui, prefix, since and since[0], scache, files)
+
+    date = None
+    if since:
+        date = datestr(since, '%Y/%m/%d %H:%M:%S %1%2')
+    if rlog and jobs > 1:
+        return _parallelentries(ui, root, directory, date, prefix, jobs,
+                                compression, scache, pipeline,
+                                skipunchanged)
+
+    # build the CVS commandline
+    cmd = _logcmd(root, rlog, date, directory, compression=compression,
+                  skipunchanged=skipunchanged)
+    ui.note(_("running %s\n") % (' '.join(cmd)))
+    return _rlogentries(ui, cmd, rlog, prefix, scache, pipeline)
+
+def _linkparents(entries, versions):
+    '''Set the parent revision of each entry and yield it.
+
+    The entries of one RCS file arrive together, so each file is sorted
+    and linked as soon as its last entry has been read. versions maps
+    (file, branch) to the latest revision seen on that branch.
+    '''
+    for rcs, group in itertools.groupby(entries, lambda e: e.rcs):
+        for e in sorted(group, key=lambda e: e.revision):
+            branch = e.revision[:-1]
+            p = versions.get((e.file, branch), None)
+            if p is None:
+                p = e.revision[:-2]
+            e.parent = p
+            versions[(e.file, branch)] = e.revision
+            yield e
+
+def iterlog(ui, directory=None, root="", rlog=True, native=False, jobs=1,
+            rlogfile=None, compression=None, pipeline=False):
+    '''Yield the CVS rlog as logentry objects, as soon as all revisions
+    of their file have been read.
+
+    Unlike createlog(), no cache is used and the entries are not sorted:
+    they come grouped by RCS file, in the order cvs reports the files,
+    and ordered by revision within each file.
+
+    If rlogfile is given, the output of an earlier cvs (r)log run is
+    read from that file ('-' for stdin) instead of running cvs.
+
+    compression is the cvs -z level, by default 3 for remote CVSROOTs.
+
+    If pipeline is true, cvs output is read by a separate thread while
+    it is parsed.
+    '''
+    _scache = {}
+    def scache(s):
+        "return a shared version of a string"
+        return _scache.setdefault(s, s)
+
+    directory, root = _sandbox(directory, root)
+    entries = _logentries(ui, root, directory, rlog, None, native, jobs,
+                          rlogfile, _compression(root, compression), scache,
+                          pipeline=pipeline)
+    for e in _linkparents(entries, {}):
+        yield e
+
+def createlog(ui, directory=None, root="", rlog=True, cache=None,
+              native=False, jobs=1, rlogfile=None, columnar=False,
+              compression=None, cacheformat='pickle', margin=0,
+              pipeline=False, skipunchanged=False):
+    '''Collect the CVS rlog, or replay a saved one from rlogfile
+
+    If columnar is true, the log is collected in a logstore instead of
+    a list, which takes much less memory for very large histories.
+
+    compression is the cvs -z level, by default 3 for remote CVSROOTs.
+
+    cacheformat is 'pickle' or 'sqlite', the format of the log cache.
+
+    When the cache is updated, the log is read again from margin seconds
+    before the latest cached commit, to catch commits that were reported
+    late. Entries that are already cached are skipped.
+
+    If pipeline is true, cvs output is read by a separate thread while
+    it is parsed, and statistics show which side was waiting.
+
+    If skipunchanged is true, an update asks cvs to leave out the files
+    without new revisions, which needs cvs 1.12 or CVSNT on the server.
+    '''
+
+    # Because we store many duplicate commit log messages, reusing strings
+    # saves a lot of memory and pickle storage space.
+    _scache = {}
+    def scache(s):
+        "return a shared version of a string"
+        return _scache.setdefault(s, s)
+
+    ui.status(_('collecting CVS rlog\n'))
+
+    # list of logentry objects containing the CVS state
+    if columnar:
+        log = logstore.logstore()
+    else:
+        log = []
+    rcsmap = {}
+
+    directory, root = _sandbox(directory, root)
+
     # read log cache if one exists
     oldlog = []
-    date = None
+    oldstats = {}
+    versions = {}
+    segments = []
+    cacheread = False
 
     update_log = cache in ('write', 'update')
 
+    if rlogfile is not None:
+        # a saved log is complete, and is neither merged into nor
+        # stored in the cache
+        cache = None
+        update_log = True
+
     if cache:
-        cachedir = os.path.expanduser('~/.pycvsps')
-        if not os.path.exists(cachedir):
-            os.mkdir(cachedir)
-
-        # The cvsps cache pickle needs a uniquified name, based on the
-        # repository location. The address may have all sort of nasties
-        # in it, slashes, colons and such. So here we take just the
-        # alphanumeric characters, concatenated in a way that does not
-        # mix up the various components, so that
-        #    :pserver:user@server:/path
-        # and
-        #    /pserver/user/server/path
-        # are mapped to different cache file names.
-        cachefile = root.split(":") + [directory, "cache"]
-        cachefile = ['-'.join(re.findall(r'\w+', s)) for s in cachefile if s]
-        cachefile = os.path.join(cachedir,
-                                 '.'.join([s for s in cachefile if s]))
+        cachefile = _cachefile(root, directory)
+        if cacheformat == 'sqlite':
+            cachefile += '.sqlite'
 
     if cache in ('read', 'update'):
         try:
             ui.note(_('reading cvs log cache %s\n') % cachefile)
-            oldlog = pickle.load(open(cachefile, 'rb'))
+            if cacheformat == 'sqlite':
+                db = sqlcache.logdb(cachefile, create=False)
+                try:
+                    oldlog = db.read(logentry)
+                    oldstats = db.stats()
+                    versions = db.versions()
+                finally:
+                    db.close()
+            else:
+                oldlog, oldstats, versions, segments = _readcache(cachefile)
+            cacheread = True
             ui.note(_('cache has %d log entries\n') % len(oldlog))
         except Exception as e:
             ui.note(_('error reading cache: %r\n') % e)
+            oldlog = []
+            oldstats = {}
+            versions = {}
             update_log = True
-
-        if oldlog:
-            date = oldlog[-1].date    # last commit date as a (time,tz) tuple
-            date = datestr(date, '%Y/%m/%d %H:%M:%S %1%2')
+    oldlog = _aslog(oldlog, columnar)
 
     if not update_log:
         return oldlog
 
-    # build the CVS commandline
-    cmd = ['cvs', '-q']
-    if root:
-        cmd.append('-d%s' % root)
-    cmd.append(['log', 'rlog'][rlog])
-    if date:
-        # no space between option and date string
-        cmd.append('-d>%s' % date)
-    cmd.append(directory)
-    prefix = build_prefix(root, directory)
-
-    # state machine begins here
-    tags = {}     # dictionary of revisions on current file with their tags
-    branchmap = {} # mapping between branch names and revision numbers
-    rcsmap = {}
-    state = 0
-    store = False # set when a new record can be appended
-
-    ui.note(_("running %s\n") % (' '.join(cmd)))
-    ui.debug("prefix=%r directory=%r root=%r\n" % (prefix, directory, root))
-
-    pfp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    peek = pfp.stdout.readline().decode('latin-1')
-    while True:
-        line = peek
-        if line == '':
-            break
-        peek = pfp.stdout.readline().decode('latin-1')
-        if line.endswith('\n'):
-            line = line[:-1]
-        #ui.debug('state=%d line=%r\n' % (state, line))
-
-        if state == 0:
-            # initial state, consume input until we see 'RCS file'
-            match = re_00.match(line)
-            if match:
-                rcs = match.group(1)
-                tags = {}
-                if rlog:
-                    filename = os.path.normpath(rcs[:-2])
-                    if filename.startswith(prefix):
-                        filename = filename[len(prefix):]
-                        filename = rcs_path(filename)
-                        state = 2
-                    continue
-                state = 1
-                continue
-            match = re_01.match(line)
-            if match:
-                raise logerror(match.group(1))
-            match = re_02.match(line)
-            if match:
-                raise logerror(match.group(2))
-            if re_03.match(line):
-                raise logerror(line)
-
-        elif state == 1:
-            # expect 'Working file' (only when using log instead of rlog)
-            match = re_10.match(line)
-            assert match, _('RCS file must be followed by working file')
-            filename = os.path.normpath(match.group(1))
-            state = 2
-
-        elif state == 2:
-            # expect 'symbolic names'
-            if re_20.match(line):
-                branchmap = {}
-                state = 3
-
-        elif state == 3:
-            # read the symbolic names and store as tags
-            match = re_30.match(line)
-            if match:
-                rev = parse_revision(match.group(2))
-
-                # Convert magic branch number to an odd-numbered one
-                revn = len(rev)
-                if revn > 3 and (revn % 2) == 0 and rev[-2] == 0:
-                    rev = rev[:-2] + rev[-1:]
-
-                if rev not in tags:
-                    tags[rev] = []
-                tags[rev].append(match.group(1))
-                branchmap[match.group(1)] = match.group(2)
-
-            elif re_31.match(line):
-                state = 5
-            elif re_32.match(line):
-                state = 0
-
-        elif state == 4:
-            # expecting '------' separator before first revision
-            if re_31.match(line):
-                state = 5
-            else:
-                assert not re_32.match(line), _('must have at least '
-                                                'some revisions')
-
-        elif state == 5:
-            # expecting revision number and possibly (ignored) lock indication
-            # we create the logentry here from values stored in states 0 to 4,
-            # as this state is re-entered for subsequent revisions of a file.
-            match = re_50.match(line)
-            assert match, _('expected revision number')
-            e = logentry(rcs=scache(rcs),
-                         file=scache(filename),
-                         revision=parse_revision(match.group(1)),
-                         branches=[],
-                         parent=None,
-                         commitid=None,
-                         mergepoint=None,
-                         branchpoints=set())
-
-            state = 6
-
-        elif state == 6:
-            # expecting date, author, state, lines changed
-            match = re_60.match(line)
-            assert match, _('revision must be followed by date line')
-            d = match.group(1)
-            if d[2] == '/':
-                # Y2K
-                d = '19' + d
-
-            if len(d.split()) != 3:
-                # cvs log dates always in GMT
-                d = d + ' UTC'
-            e.date = parsedate(d, ['%y/%m/%d %H:%M:%S',
-                                   '%Y/%m/%d %H:%M:%S',
-                                   '%Y-%m-%d %H:%M:%S'])
-            e.author = scache(match.group(2))
-            e.dead = match.group(3).lower() == 'dead'
-
-            if match.group(5):
-                if match.group(6):
-                    e.lines = (int(match.group(5)), int(match.group(6)))
-                else:
-                    e.lines = (int(match.group(5)), 0)
-            elif match.group(6):
-                e.lines = (0, int(match.group(6)))
-            else:
-                e.lines = None
-
-            if match.group(7): # cvs 1.12 commitid
-                e.commitid = match.group(8)
-
-            if match.group(9): # cvsnt mergepoint
-                myrev = match.group(10).split('.')
-                if len(myrev) == 2: # head
-                    e.mergepoint = 'HEAD'
-                else:
-                    myrev = '.'.join(myrev[:-2] + ['0', myrev[-2]])
-                    branches = [b for b in branchmap if branchmap[b] == myrev]
-                    assert len(branches) == 1, ('unknown branch: %s'
-                                                % e.mergepoint)
-                    e.mergepoint = branches[0]
-
-            e.comment = []
-            state = 7
-
-        elif state == 7:
-            # read the revision numbers of branches that start at this revision
-            # or store the commit log message otherwise
-            m = re_70.match(line)
-            if m:
-                e.branches = [
-                    parse_revision(x.strip()) for x in m.group(1).split(';')
-                ]
-                state = 8
-            elif re_31.match(line) and re_50.match(peek):
-                state = 5
-                store = True
-            elif re_32.match(line):
-                state = 0
-                store = True
-            else:
-                e.comment.append(line)
-
-        elif state == 8:
-            # store commit log message
-            if re_31.match(line):
-                cpeek = peek
-                if cpeek.endswith('\n'):
-                    cpeek = cpeek[:-1]
-                if re_50.match(cpeek):
-                    state = 5
-                    store = True
-                else:
-                    e.comment.append(line)
-            elif re_32.match(line):
-                state = 0
-                store = True
-            else:
-                e.comment.append(line)
-
-        # When a file is added on a branch B1, CVS creates a synthetic
-        # dead trunk revision 1.1 so that the branch has a root.
-        # Likewise, if you merge such a file to a later branch B2 (one
-        # that already existed when the file was added on B1), CVS
-        # creates a synthetic dead revision 1.1.x.1 on B2.  Don't drop
-        # these revisions now, but mark them synthetic so
-        # createchangeset() can take care of them.
-        if (store and
-              e.dead and
-              e.revision[-1] == 1 and      # 1.1 or 1.1.x.1
-              len(e.comment) == 1 and
-              file_added_re.match(e.comment[0])):
-            ui.debug('found synthetic revision in %s: %r\n'
-                     % (e.rcs, e.comment[0]))
-            e.synthetic = True
-
-        if store:
-            # clean up the results and save in the log.
-            store = False
-            e.tags = sorted([scache(x) for x in tags.get(e.revision, [])])
-            e.comment = scache('\n'.join(e.comment))
-
-            revn = len(e.revision)
-            if revn > 3 and (revn % 2) == 0:
-                e.branch = tags.get(e.revision[:-1], [None])[0]
+    def writecache(entries, stats, replace):
+        # a cache that could not be read is replaced as a whole
+        replace = replace or not cacheread
+        if replace:
+            heads = versions
+        else:
+            # only the branches of the new entries moved on
+            heads = {}
+            for e in entries:
+                key = (e.file, e.revision[:-1])
+                heads[key] = versions[key]
+        if cacheformat == 'sqlite':
+            ui.note(_('writing cvs log cache %s\n') % cachefile)
+            db = sqlcache.logdb(cachefile)
+            try:
+                db.write(entries, stats, heads, replace)
+            finally:
+                db.close()
+        else:
+            _writecache(ui, cachefile, segments, entries, stats, heads,
+                        replace)
+
+    newstats = None
+    files = None
+    since = None
+    seen = set()
+    if cache and native and rlog and _localroot(root) is not None:
+        # The cache of a local repository records the state of each RCS
+        # file. Files that changed in any way, including tags added or
+        # moved on old revisions, are read again in full and replace
+        # their cached entries and branch revisions.
+        newstats = _rcsstats(build_prefix(root, directory))
+        files = [rcs for rcs, st in newstats.items()
+                 if oldstats.get(rcs) != st]
+        kept = []
+        for e in oldlog:
+            if e.rcs in oldstats and newstats.get(e.rcs) == oldstats[e.rcs]:
+                kept.append(e)
             else:
-                e.branch = None
-
-            # find the branches starting from this revision
-            branchpoints = set()
-            for branch, revision in branchmap.items():
-                revparts = parse_revision(revision)
-                if len(revparts) < 2: # bad tags
-                    continue
-                if revparts[-2] == 0 and revparts[-1] % 2 == 0:
-                    # normal branch
-                    if revparts[:-2] == e.revision:
-                        branchpoints.add(branch)
-                elif revparts == (1, 1, 1): # vendor branch
-                    if revparts in e.branches:
-                        branchpoints.add(branch)
-            e.branchpoints = branchpoints
-
-            log.append(e)
-
-            rcsmap[e.file] = e.rcs
-
-            if len(log) % 100 == 0:
-                ui.status(ellipsis('%d %s' % (len(log), e.file), 80) + '\n')
+                versions.pop((e.file, e.revision[:-1]), None)
+        oldlog = _aslog(kept, columnar)
+        ui.note(_('%d of %d RCS files changed\n')
+                % (len(files), len(newstats)))
+    elif oldlog:
+        # last commit date as a (time,tz) tuple, less the margin
+        since = oldlog[-1].date
+        since = (since[0] - margin, since[1])
+
+        # cached entries that may be reported again
+        for e in reversed(oldlog):
+            if e.date[0] < since[0]:
+                break
+            seen.add((e.file, e.revision))
+
+    # find parent revisions of individual files, continuing from the
+    # latest cached revision on each branch, which _linkparents() keeps
+    # up to date in versions
+    _logdate.cache_clear()
+    _revision.cache_clear()
+
+    entries = _logentries(ui, root, directory, rlog, since, native, jobs,
+                          rlogfile, _compression(root, compression), scache,
+                          files, pipeline, skipunchanged)
+    if seen:
+        # skipped before linking, so that versions does not go back to
+        # older revisions
+        entries = (e for e in entries if (e.file, e.revision) not in seen)
+    for e in _linkparents(entries, versions):
+        log.append(e)
+
+        rcsmap[e.file] = e.rcs
+
+        if len(log) % 100 == 0:
+            ui.status(ellipsis('%d %s' % (len(log), e.file), 80) + '\n')
+
+    for name, cached in (('date', _logdate), ('revision', _revision)):
+        info = cached.cache_info()
+        ui.note(_('%s cache: %d hits, %d misses\n')
+                % (name, info.hits, info.misses))
 
     log.sort(key=lambda x: (x.rcs, x.revision))
 
-    # find parent revisions of individual files
-    versions = {}
-    for e in sorted(oldlog, key=lambda x: (x.rcs, x.revision)):
-        if e.file in rcsmap:
+    # files may have moved to or from the Attic since the cache was written
+    moved = False
+    for e in oldlog:
+        if e.file in rcsmap and e.rcs != rcsmap[e.file]:
             e.rcs = rcsmap[e.file]
-        branch = e.revision[:-1]
-        versions[(e.rcs, branch)] = e.revision
-
-    for e in log:
-        branch = e.revision[:-1]
-        p = versions.get((e.rcs, branch), None)
-        if p is None:
-            p = e.revision[:-2]
-        e.parent = p
-        versions[(e.rcs, branch)] = e.revision
+            moved = True
 
     # update the log cache
     if cache:
-        if log:
+        if newstats is not None and newstats != oldstats:
+            # join up the entries of unchanged and changed files, in the
+            # order a full run would give; as cached entries were
+            # replaced, the cache is written anew
+            log = oldlog + log
+            log.sort(key=lambda x: (x.date, x.rcs, x.revision))
+            writecache(log, newstats, True)
+        elif newstats is None and log:
             # join up the old and new logs
             log.sort(key=lambda x: x.date)
 
-            if oldlog and oldlog[-1].date >= log[0].date:
-                raise logerror(_('log cache overlaps with new log entries,'
-                                 ' re-run without cache.'))
-
+            new = log
             log = oldlog + log
 
-            # write the new cachefile
-            ui.note(_('writing cvs log cache %s\n') % cachefile)
-            pickle.dump(log, open(cachefile, 'wb'))
+            if oldlog and oldlog[-1].date >= new[0].date:
+                # Commits were reported late, e.g. because of clock
+                # skew. Both parts are sorted, so sorting merges them
+                # in linear time; as entries moved, the cache is
+                # written anew.
+                ui.note(_('%d new log entries are older than the cache\n')
+                        % sum(1 for e in new if e.date <= oldlog[-1].date))
+                log.sort(key=lambda x: x.date)
+                writecache(log, {}, True)
+
+            # append the new entries to the cache, or merge all segments
+            # once there are too many of them; cached entries of files
+            # that moved to or from the Attic changed, so the cache is
+            # then written anew as well
+            elif moved or len(segments) + 1 >= _maxsegments:
+                writecache(log, {}, True)
+            else:
+                writecache(new, {}, False)
         else:
             log = oldlog
 
@@ -535,6 +1307,7 @@ class changeset(object):
         self.synthetic = False
         self._files = set()
         self._versions = set()
+        self._fileparents = None
         self.author = author
         self.branch = branch
         self.comment = comment
@@ -628,19 +1401,203 @@ class changeset(object):
         return True
 
     def is_child(self, other):
-        for entry in self.entries:
-            if (entry.rcs, entry.parent) in other._versions:
-                return True
-        return False
+        '''Return True if other holds the previous revision of one of
+        the entries; both must have been linked by _linkfileparents()'''
+        return other in self._fileparents
 
     def __repr__(self):
         items = ("%s=%r"%(k, self.__dict__[k]) for k in sorted(self.__dict__))
         return "%s(%s)"%(type(self).__name__, ", ".join(items))
 
-def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
-    '''Convert log into changesets.'''
+def _reopenpoint(previous, log, fuzz):
+    '''Return the index of the first changeset in previous that the
+    entries in log could join or be ordered before'''
+    first = min(sum(e.date) for e in log)
+    k = len(previous)
+    while k and sum(previous[k - 1].date) + fuzz >= first:
+        k -= 1
+
+    # entries with a commitid join their changeset whatever its date
+    commitids = set(e.commitid for e in log if e.commitid)
+    if commitids:
+        for i in range(k):
+            if previous[i].commitid in commitids:
+                k = i
+                break
 
-    ui.status(_('creating changesets\n'))
+    # keep merge changesets with the changeset they merge from
+    while 0 < k < len(previous) and not previous[k].entries:
+        k -= 1
+    return k
+
+def _branchstarts(changesets):
+    '''Return the index of the latest changeset on each branch, as
+    createchangeset() records it when finding parents'''
+    branches = {}
+    for i, c in enumerate(changesets):
+        nxt = changesets[i + 1:i + 2]
+        if nxt and not nxt[0].entries and nxt[0].parents[:1] == [c]:
+            # a changeset merged to another branch is followed by the
+            # merge changeset, which takes its place
+            continue
+        branches[c.branch] = i
+    return branches
+
+def _linkfileparents(changesets):
+    '''Record in each of changesets the others holding the previous
+    revision of one of its entries, for is_child()'''
+    owner = {}
+    for c in changesets:
+        for v in c._versions:
+            owner[v] = c
+    for c in changesets:
+        parents = set()
+        for e in c.entries:
+            p = owner.get((e.rcs, e.parent))
+            if p is not None and p is not c:
+                parents.add(p)
+        c._fileparents = parents
+
+# changesets with the same date are only ordered one group at a time
+# if there are at most this many of them
+_maxtied = 100
+
+def _cscmp(l, r, odd):
+    '''Compare changesets l and r, linked by _linkfileparents(), for
+    sorting. Pairs that are each a child of the other are added to odd.'''
+    d = sum(l.date) - sum(r.date)
+    if d:
+        return d
+
+    # detect vendor branches and initial commits on a branch
+    if l.is_child(r):
+        d = 1
+
+    if r.is_child(l):
+        if d:
+            odd.add((l, r))
+        d = -1
+    # By this point, the changesets are sufficiently compared that
+    # we don't really care about ordering. However, this leaves
+    # some race conditions in the tests, so we compare on the
+    # number of files modified, the files contained in each
+    # changeset, and the branchpoints in the change to ensure test
+    # output remains stable.
+
+    # recommended replacement for cmp from
+    # https://docs.python.org/3.0/whatsnew/3.0.html
+    def c(x, y):
+        return (x > y) - (x < y)
+
+    # Sort bigger changes first.
+    if not d:
+        d = c(len(l.entries), len(r.entries))
+    # Try sorting by filename in the change.
+    if not d:
+        d = c([e.file for e in l.entries], [e.file for e in r.entries])
+    # Try and put changes without a branch point before ones with
+    # a branch point.
+    if not d:
+        d = c(len(l.branchpoints), len(r.branchpoints))
+    return d
+
+def _ordertied(group):
+    '''Return group, changesets with the same date, sorted by _cscmp(),
+    or None if _cscmp() does not order them consistently.
+
+    _cscmp() is not consistent for some changesets, e.g. when one is
+    before another as its parent, but after a third one that is before
+    the other by the number of files. How a sort then orders them
+    depends on all the changesets sorted with them.
+    '''
+    if len(group) > _maxtied:
+        return None
+
+    def sign(x):
+        return (x > 0) - (x < 0)
+
+    # pairs that are each a child of the other are found again when
+    # the whole list is sorted
+    odd = set()
+    def cmp(l, r):
+        return sign(_cscmp(l, r, odd))
+
+    group = sorted(group, key=functools.cmp_to_key(cmp))
+
+    # the comparison is consistent if it gives the same as comparing
+    # the ranks of the changesets in the sorted group, where each
+    # changeset ranks after the previous one unless they compare equal
+    ranks = [0]
+    for i in range(1, len(group)):
+        ranks.append(ranks[-1] + (cmp(group[i - 1], group[i]) != 0))
+    for i in range(len(group)):
+        for j in range(i + 1, len(group)):
+            d = sign(ranks[i] - ranks[j])
+            if cmp(group[i], group[j]) != d or cmp(group[j], group[i]) != -d:
+                return None
+    return group
+
+def _tiedgroups(changesets):
+    '''Yield the groups of changesets with the same date in changesets,
+    which are sorted by date, leaving out merge changesets'''
+    changesets = (c for c in changesets if c.entries)
+    for date, group in itertools.groupby(changesets, lambda c: sum(c.date)):
+        group = list(group)
+        if len(group) > 1:
+            yield group
+
+def _sortchangesets(changesets, odd):
+    '''Sort changesets, linked by _linkfileparents(), with _cscmp().
+
+    Most changesets differ in date, which a key orders quickly, and only
+    changesets with the same date are compared one group at a time. If
+    a group is not ordered consistently, the whole list is sorted with
+    the comparison, which gives the order cvsps always gave, and False
+    is returned. Otherwise the order of each changeset only depends on
+    those with the same date, and True is returned.
+    '''
+    bydate = sorted(changesets, key=lambda c: sum(c.date))
+    ordered = []
+    for date, group in itertools.groupby(bydate, lambda c: sum(c.date)):
+        group = list(group)
+        if len(group) > 1:
+            group = _ordertied(group)
+            if group is None:
+                changesets.sort(key=functools.cmp_to_key(
+                    lambda l, r: _cscmp(l, r, odd)))
+                return False
+        ordered.extend(group)
+    changesets[:] = ordered
+    return True
+
+def _branchparent(positions, end, merged):
+    '''Return the last of the first run of consecutive positions, up
+    to end, of the changesets a branch starts from, or None.
+
+    A merge changeset inserted after a position (one of merged, which
+    is sorted) intervenes and ends the run.
+
+    >>> _branchparent([2, 3, 4, 7], 10, [])
+    4
+    >>> _branchparent([2, 3, 4, 7], 10, [3]), _branchparent([2, 3, 4, 7], 4, [])
+    (3, 3)
+    >>> _branchparent([5], 5, []), _branchparent(None, 5, [])
+    (None, None)
+    '''
+    if not positions or positions[0] >= end:
+        return None
+    p = positions[0]
+    for q in itertools.islice(positions, 1, None):
+        if q != p + 1 or q >= end:
+            break
+        k = bisect.bisect_left(merged, p)
+        if k < len(merged) and merged[k] == p:
+            break
+        p = q
+    return p
+
+def _groupentries(ui, log, fuzz):
+    '''Group log entries into changesets'''
 
     # try to order commitids by date
     mindate = {}
@@ -674,53 +1631,150 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
             if len(changesets) % 100 == 0:
                 t = '%d %s' % (len(changesets), repr(e.comment)[1:-1])
                 ui.status(ellipsis(t, 80) + '\n')
+    return changesets
+
+def _groupcommits(ui, log):
+    '''Group log entries, which all have a commitid, into changesets.
+
+    CVS 1.12 and later give every commit a commitid. Entries are then
+    collected by commitid in one pass, and only the entries of each
+    commit are sorted, as _groupentries() would order them, to split
+    the commit where branchpoints differ.
+
+    >>> class ui:
+    ...     def status(self, msg): pass
+    >>> def entry(file, date, commitid, branchpoints=()):
+    ...     return logentry(rcs=file + ',v', file=file, revision=(1, 1),
+    ...                     parent=None, date=(date, 0), author='ann',
+    ...                     branch=None, comment='fix', commitid=commitid,
+    ...                     mergepoint=None, dead=False, synthetic=False,
+    ...                     lines=None, tags=[], branches=[],
+    ...                     branchpoints=set(branchpoints))
+    >>> log = [entry('a.c', 2000, 'c2'), entry('d.c', 1001, 'c1'),
+    ...        entry('c.c', 1002, 'c1', ['BR']), entry('b.c', 1000, 'c1')]
+    >>> for c in _groupcommits(ui(), log):
+    ...     print(c.commitid, [e.file for e in c.entries], sorted(c.branchpoints))
+    c1 ['b.c', 'd.c'] []
+    c1 ['c.c'] ['BR']
+    c2 ['a.c'] []
+    '''
+    commits = {}
+    for e in log:
+        commits.setdefault(e.commitid, []).append(e)
+
+    # try to order commitids by date
+    order = sorted(commits.items(),
+                   key=lambda item: (min(e.date for e in item[1]), item[0]))
+
+    changesets = []
+    for commitid, entries in order:
+        if len(entries) > 1:
+            entries.sort(key=lambda x: (x.comment, x.author, x.branch or '',
+                                        x.date, x.branchpoints))
+        c = None
+        for e in entries:
+            if c is not None and e.branchpoints == c.branchpoints:
+                c._add(e)
+                continue
+            c = changeset.from_logentry(e)
+            changesets.append(c)
+
+            if len(changesets) % 100 == 0:
+                t = '%d %s' % (len(changesets), repr(e.comment)[1:-1])
+                ui.status(ellipsis(t, 80) + '\n')
+    return changesets
+
+def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None,
+                    previous=None, keepsynthetic=False):
+    '''Convert log into changesets.
+
+    If previous is given, it is the result of an earlier call, and log
+    only holds the entries added to its log since. Only the changesets
+    that new entries may join or be ordered before are made again; the
+    earlier ones are reused and keep their ids. None is returned if the
+    result could then differ from converting the whole log, which
+    happens when changesets with the same date are involved.
+
+    If keepsynthetic is true, synthetic changesets are left in the
+    result, without an id. A branch may start from one of them, so
+    previous must be such a result to give the same changesets as
+    converting the whole log at once.
+
+    A merge changeset follows each {{mergetobranch}} commit, and the
+    synthetic changeset adding b.c on the branch is dropped:
+
+    >>> class ui:
+    ...     def status(self, msg): pass
+    ...     note = warn = status
+    >>> def entry(file, revision, parent, date, comment, branch=None, **kw):
+    ...     fields = dict(rcs=file + ',v', file=file, revision=revision,
+    ...                   parent=parent, date=(date, 0), author='ann',
+    ...                   branch=branch, comment=comment, commitid=None,
+    ...                   mergepoint=None, dead=False, synthetic=False,
+    ...                   lines=None, tags=[], branches=[], branchpoints=set())
+    ...     fields.update(kw)
+    ...     return logentry(**fields)
+    >>> log = [
+    ...     entry('a.c', (1, 1), None, 1000, 'init', branchpoints={'BR'}),
+    ...     entry('b.c', (1, 1), None, 1100,
+    ...           'file b.c was initially added on branch BR.',
+    ...           dead=True, synthetic=True, branchpoints={'BR'}),
+    ...     entry('b.c', (1, 1, 2, 1), (1, 1), 1200, 'add b', branch='BR'),
+    ...     entry('a.c', (1, 2), (1, 1), 1250, 'more'),
+    ...     entry('a.c', (1, 1, 2, 1), (1, 1), 1300,
+    ...           'fix {{mergetobranch HEAD}}', branch='BR'),
+    ...     entry('a.c', (1, 3), (1, 2), 1400, 'last')]
+    >>> for c in createchangeset(ui(), log):
+    ...     print(c.id, c.branch, c.comment, [p.id for p in c.parents])
+    1 None init []
+    2 BR add b [1]
+    3 None more [1]
+    4 BR fix {{mergetobranch HEAD}} [2]
+    5 None convert-repo: CVS merge from branch BR [4, 3]
+    6 None last [5]
+    '''
+
+    ui.status(_('creating changesets\n'))
+
+    start = 0
+    if previous:
+        start = _reopenpoint(previous, log, fuzz)
+        # changesets with the same date that are not ordered consistently
+        # are ordered differently once more changesets are sorted
+        for group in _tiedgroups(previous[:start]):
+            _linkfileparents(group)
+            if _ordertied(group) is None:
+                ui.note(_('earlier changesets with the same date are not '
+                          'ordered consistently\n'))
+                return None
+        ui.note(_('reusing %d of %d changesets\n') % (start, len(previous)))
+        log = [e for c in previous[start:] for e in c.entries] + list(log)
+
+    if log and all(e.commitid for e in log):
+        changesets = _groupcommits(ui, log)
+    else:
+        changesets = _groupentries(ui, log, fuzz)
 
     # Sort files in each changeset
     for c in changesets:
         c.entries.sort(key=lambda x: tuple(enumerate(os.path.split(x.file))))
 
+    _linkfileparents(changesets)
+
     # Sort changesets by date
 
     odd = set()
-
-    def cscmp(l, r):
-        d = sum(l.date) - sum(r.date)
-        if d:
-            return d
-
-        # detect vendor branches and initial commits on a branch
-        if l.is_child(r):
-            d = 1
-
-        if r.is_child(l):
-            if d:
-                odd.add((l, r))
-            d = -1
-        # By this point, the changesets are sufficiently compared that
-        # we don't really care about ordering. However, this leaves
-        # some race conditions in the tests, so we compare on the
-        # number of files modified, the files contained in each
-        # changeset, and the branchpoints in the change to ensure test
-        # output remains stable.
-
-        # recommended replacement for cmp from
-        # https://docs.python.org/3.0/whatsnew/3.0.html
-        def c(x, y):
-            return (x > y) - (x < y)
-
-        # Sort bigger changes first.
-        if not d:
-            d = c(len(l.entries), len(r.entries))
-        # Try sorting by filename in the change.
-        if not d:
-            d = c([e.file for e in l.entries], [e.file for e in r.entries])
-        # Try and put changes without a branch point before ones with
-        # a branch point.
-        if not d:
-            d = c(len(l.branchpoints), len(r.branchpoints))
-        return d
-
-    changesets.sort(key=functools.cmp_to_key(cscmp))
+    _sortchangesets(changesets, odd)
+
+    if start:
+        # the order of new changesets with the same date as others can
+        # depend on the order they were grouped in
+        reused = [c for c in previous[:start] if c.entries]
+        if ((reused and changesets and
+             sum(changesets[0].date) <= sum(reused[-1].date)) or
+            any(_tiedgroups(changesets))):
+            ui.note(_('new changesets have the same date as others\n'))
+            return None
 
     # Collect tags
 
@@ -738,6 +1792,15 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
         # remember tags only if this is the latest changeset to have it
         c.tags = sorted(tag for tag in tags if globaltags[tag] is c)
 
+    branches = {}    # changeset index where we saw a branch
+    if start:
+        # tags that reached newer changesets move away from reused ones
+        for c in previous[:start]:
+            if c.tags and not globaltags.keys().isdisjoint(c.tags):
+                c.tags = [tag for tag in c.tags if tag not in globaltags]
+        branches = _branchstarts(previous[:start])
+        changesets[:0] = previous[:start]
+
     # Find parent changesets, handle {{mergetobranch BRANCHNAME}}
     # by inserting dummy changesets with two parents, and handle
     # {{mergefrombranch BRANCHNAME}} by setting two parents.
@@ -752,11 +1815,20 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
     if mergefrom:
         mergefrom = re.compile(mergefrom)
 
-    branches = {}    # changeset index where we saw a branch
-    n = len(changesets)
-    i = 0
-    while i < n:
-        c = changesets[i]
+    # positions of the changesets with each branch in their branchpoints
+    starts = {}
+    for j, c in enumerate(changesets):
+        for b in c.branchpoints or ():
+            starts.setdefault(b, []).append(j)
+    # positions, in the same numbering, that merge changesets were
+    # inserted after
+    merged = []
+
+    # changesets with their parents found, and merge changesets added;
+    # branches holds positions in this list
+    linked = changesets[:start]
+    for j in range(start, len(changesets)):
+        c = changesets[j]
 
         p = None
         if c.branch in branches:
@@ -766,16 +1838,12 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
             # the parent is a changeset with the branch in its
             # branchpoints such that it is the latest possible
             # commit without any intervening, unrelated commits.
-
-            for candidate in range(i):
-                if c.branch not in changesets[candidate].branchpoints:
-                    if p is not None:
-                        break
-                    continue
-                p = candidate
+            p = _branchparent(starts.get(c.branch), j, merged)
+            if p is not None:
+                p += bisect.bisect_left(merged, p)
 
         if p is not None:
-            p = changesets[p]
+            p = linked[p]
 
             # Ensure no changeset has a synthetic changeset as a parent.
             while p.synthetic:
@@ -793,7 +1861,7 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
         if c.mergepoint:
             if c.mergepoint == 'HEAD':
                 c.mergepoint = None
-            c.parents.append(changesets[branches[c.mergepoint]])
+            c.parents.append(linked[branches[c.mergepoint]])
 
         if mergefrom:
             m = mergefrom.search(c.comment)
@@ -802,7 +1870,7 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
                 if m == 'HEAD':
                     m = None
                 try:
-                    candidate = changesets[branches[m]]
+                    candidate = linked[branches[m]]
                 except KeyError:
                     ui.warn(_("warning: CVS commit message references "
                               "non-existent branch %r:\n%s\n")
@@ -820,27 +1888,20 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
                 else:
                     m = None   # if no group found then merge to HEAD
                 if m in branches and c.branch != m:
-                    # insert empty changeset for merge
-                    cc = changeset.from_merge(c, changesets[branches[m]])
-                    changesets.insert(i + 1, cc)
-                    branches[m] = i + 1
-
-                    # adjust our loop counters now we have inserted a new entry
-                    n += 1
-                    i += 2
+                    # add empty changeset for merge
+                    cc = changeset.from_merge(c, linked[branches[m]])
+                    linked.append(c)
+                    linked.append(cc)
+                    branches[m] = len(linked) - 1
+                    merged.append(j)
                     continue
 
-        branches[c.branch] = i
-        i += 1
+        branches[c.branch] = len(linked)
+        linked.append(c)
 
     # Drop synthetic changesets (safe now that we have ensured no other
     # changesets can have them as parents).
-    i = 0
-    while i < len(changesets):
-        if changesets[i].synthetic:
-            del changesets[i]
-        else:
-            i += 1
+    changesets = [c for c in linked if not c.synthetic]
 
     # Number changesets
 
@@ -857,8 +1918,178 @@ def createchangeset(ui, log, fuzz=60, mergefrom=None, mergeto=None):
 
     # hook.hook(ui, None, "cvschangesets", True, changesets=changesets)
 
+    if keepsynthetic:
+        return linked
     return changesets
 
+def _loghash(fuzz, mergefrom, mergeto):
+    '''Return a hash object for the log digest of changesets made with
+    the given options'''
+    return hashlib.sha1(repr((_changesetmagic, fuzz, mergefrom,
+                              mergeto)).encode('utf-8'))
+
+def _hashentries(h, entries):
+    '''Add the fields of entries that createchangeset() results depend
+    on to the hash object h'''
+    for e in entries:
+        # repr() escapes whatever cannot be encoded
+        h.update(repr((e.rcs, e.file, e.revision, e.parent, e.date,
+                       e.author, e.branch, e.comment, e.commitid,
+                       e.mergepoint, e.dead, e.synthetic, e.tags,
+                       sorted(e.branchpoints))).encode('utf-8'))
+
+def _readchangesets(path, entries):
+    '''Read the changesets stored in path and return the digest and
+    length of the log they were made from, and the changesets, with the
+    synthetic ones. Their entries are taken from the start of entries.
+    Return None if the stored log was longer than entries.'''
+    with open(path, 'rb') as fp:
+        if fp.read(len(_changesetmagic)) != _changesetmagic:
+            return None
+        digest, size = pickle.load(fp)
+        if size > len(entries):
+            return None
+        count, records = pickle.load(fp)
+
+    changesets = []
+    for (author, branch, comment, date, commitid, branchpoints, mergepoint,
+         synthetic, tags, members, parents) in records:
+        c = changeset(author, branch, comment, date, commitid, branchpoints,
+                      mergepoint)
+        c.entries = [entries[i] for i in members]
+        c.synthetic = synthetic
+        c.tags = tags
+        c._files = set(e.file for e in c.entries)
+        c._versions = set((e.rcs, e.revision) for e in c.entries)
+        changesets.append(c)
+    for c, record in zip(changesets, records):
+        c.parents = [changesets[i] for i in record[-1]]
+    del changesets[count:]
+    for i, c in enumerate(c for c in changesets if not c.synthetic):
+        c.id = i + 1
+    return digest, size, changesets
+
+def _writechangesets(ui, path, digest, entries, changesets):
+    '''Store changesets made from entries in path'''
+    members = dict((id(e), i) for i, e in enumerate(entries))
+
+    # Parents are stored as indexes, so that long histories do not
+    # exceed the recursion limit of pickle. Parents that are not among
+    # changesets are stored after them.
+    index = dict((id(c), i) for i, c in enumerate(changesets))
+    records = []
+    i = 0
+    allchangesets = list(changesets)
+    while i < len(allchangesets):
+        c = allchangesets[i]
+        parents = []
+        for p in c.parents:
+            if id(p) not in index:
+                index[id(p)] = len(allchangesets)
+                allchangesets.append(p)
+            parents.append(index[id(p)])
+        records.append((c.author, c.branch, c.comment, c.date, c.commitid,
+                        c.branchpoints, c.mergepoint, c.synthetic, c.tags,
+                        [members[id(e)] for e in c.entries], parents))
+        i += 1
+
+    ui.note(_('writing changeset cache %s\n') % path)
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(_changesetmagic)
+        pickle.dump((digest, len(entries)), fp)
+        pickle.dump((len(changesets), records), fp)
+    os.replace(path + '.tmp', path)
+
+def _firstdifference(changesets, others):
+    '''Return the index of the first changeset that differs between
+    changesets and others, or None if they are the same'''
+    def fields(c):
+        return (c.id, c.author, c.branch, c.comment, c.date, c.tags,
+                sorted(c.branchpoints or ()), c.mergepoint,
+                [(e.rcs, e.revision) for e in c.entries],
+                [p.id for p in c.parents])
+    for k, (c, o) in enumerate(zip(changesets, others)):
+        if fields(c) != fields(o):
+            return k
+    if len(changesets) != len(others):
+        return min(len(changesets), len(others))
+    return None
+
+def cachedchangesets(ui, log, path, fuzz=60, mergefrom=None, mergeto=None,
+                     refresh=False, store=True, check=False):
+    '''Convert log into changesets like createchangeset(), reusing the
+    ones stored in path if they were made with the same options from
+    the same log, or from the start of it, and storing them there. When
+    extending stored changesets could give a different result, the whole
+    log is converted again.
+
+    If refresh is true, the stored changesets are not read; unless store
+    is true, new changesets are not written. If check is true, changesets
+    made from stored ones are compared with those made from the whole
+    log, and the latter are used if they differ.
+    '''
+    entries = list(log)
+    h = _loghash(fuzz, mergefrom, mergeto)
+    size = 0
+    previous = None
+
+    if not refresh:
+        try:
+            ui.note(_('reading changeset cache %s\n') % path)
+            stored = _readchangesets(path, entries)
+            if stored is not None:
+                digest, size, previous = stored
+                _hashentries(h, itertools.islice(entries, size))
+                if h.hexdigest() != digest:
+                    h = _loghash(fuzz, mergefrom, mergeto)
+                    size = 0
+                    previous = None
+            if previous is None:
+                ui.note(_('log changed since changesets were cached\n'))
+        except Exception as e:
+            ui.note(_('error reading changeset cache: %r\n') % e)
+            h = _loghash(fuzz, mergefrom, mergeto)
+            size = 0
+            previous = None
+
+    if previous is not None and size == len(entries):
+        changesets = previous
+    else:
+        # createchangeset() sorts the log it is given, entries keeps the
+        # order the digest was taken in
+        new = entries[size:]
+        _hashentries(h, new)
+        changesets = createchangeset(ui, new, fuzz, mergefrom, mergeto,
+                                     previous, keepsynthetic=True)
+        if changesets is None:
+            ui.note(_('cached changesets cannot be extended, converting '
+                      'the whole log\n'))
+            previous = None
+            changesets = createchangeset(ui, list(entries), fuzz, mergefrom,
+                                         mergeto, keepsynthetic=True)
+    result = [c for c in changesets if not c.synthetic]
+
+    if check and previous is not None:
+        full = createchangeset(ui, list(entries), fuzz, mergefrom, mergeto,
+                               keepsynthetic=True)
+        fullresult = [c for c in full if not c.synthetic]
+        k = _firstdifference(result, fullresult)
+        if k is None:
+            ui.status(_('cached changesets match the whole log\n'))
+        else:
+            ui.warn(_('changeset %d differs from the one made from the '
+                      'whole log\n') % (k + 1))
+            changesets, result = full, fullresult
+
+    if changesets is previous:
+        ui.status(_('%d changeset entries\n') % len(result))
+        return result
+    if store:
+        try:
+            _writechangesets(ui, path, h.hexdigest(), entries, changesets)
+        except (IOError, OSError) as e:
+            ui.note(_('error writing changeset cache: %r\n') % e)
+    return result
 
 def debugcvsps(ui, *args, **opts):
     '''Read CVS rlog for current directory or named path in
@@ -876,16 +2107,49 @@ def debugcvsps(ui, *args, **opts):
 
     try:
         if args:
-            log = []
+            if opts["columnar"]:
+                log = logstore.logstore()
+            else:
+                log = []
             for d in args:
-                log += createlog(ui, d, root=opts["root"], cache=cache)
+                log += createlog(ui, d, root=opts["root"], cache=cache,
+                                 native=opts["native"], jobs=opts["jobs"],
+                                 rlogfile=opts["rlog_file"],
+                                 columnar=opts["columnar"],
+                                 compression=opts["compression"],
+                                 cacheformat=opts["cache_format"],
+                                 margin=opts["cache_margin"],
+                                 pipeline=opts["pipeline"],
+                                 skipunchanged=opts["skip_unchanged"])
+        else:
+            log = createlog(ui, root=opts["root"], cache=cache,
+                            native=opts["native"], jobs=opts["jobs"],
+                            rlogfile=opts["rlog_file"],
+                            columnar=opts["columnar"],
+                            compression=opts["compression"],
+                            cacheformat=opts["cache_format"],
+                            margin=opts["cache_margin"],
+                            pipeline=opts["pipeline"],
+                            skipunchanged=opts["skip_unchanged"])
+        if opts["rlog_file"] is None:
+            # changesets are cached next to the log cache
+            dirs = [_sandbox(d, opts["root"]) for d in args or [None]]
+            path = _cachefile(dirs[0][1], ' '.join(d for d, r in dirs))
         else:
-            log = createlog(ui, root=opts["root"], cache=cache)
+            path = None
     except logerror as e:
         ui.write("%r\n"%e)
         return
 
-    changesets = createchangeset(ui, log, opts["fuzz"])
+    if path is None:
+        changesets = createchangeset(ui, log, opts["fuzz"])
+    else:
+        # like the log cache, changesets are only stored when the log
+        # cache is written or updated
+        changesets = cachedchangesets(ui, log, path + '.changesets',
+                                      opts["fuzz"], refresh=cache == "write",
+                                      store=cache != "read",
+                                      check=opts["check_cache"])
     del log
 
     # Print changesets (optionally filtered)
@@ -966,7 +2230,7 @@ def main():
     '''Main program to mimic cvsps.'''
 
     op = OptionParser(
-        usage='%prog [-bpruvxz] path',
+        usage='%prog [-bpruvxzZ] path',
         description='Read CVS rlog for current directory or named '
         'path in repository, and convert the log to changesets '
         'based on matching commit log entries and dates.',
@@ -1028,6 +2292,15 @@ def main():
         help='Set commit time fuzz',
         metavar='seconds',
     )
+    op.add_option(
+        '-Z',
+        dest='compression',
+        action='store',
+        type='int',
+        help='Compress the cvs network traffic with this gzip level '
+        '(default 3 for remote cvsroots, 0 to disable)',
+        metavar='level',
+    )
     op.add_option(
         '--root',
         dest='root',
@@ -1050,6 +2323,80 @@ def main():
         action='store_true',
         help='Show current changeset in ancestor branches',
     )
+    op.add_option(
+        '--native',
+        dest='native',
+        action='store_true',
+        help='Read RCS files directly instead of running cvs '
+        '(local cvsroot only)',
+    )
+    op.add_option(
+        '-j',
+        '--jobs',
+        dest='jobs',
+        action='store',
+        type='int',
+        default=1,
+        help='Run up to N cvs rlog processes in parallel, one for each '
+        'subdirectory',
+        metavar='N',
+    )
+    op.add_option(
+        '--pipeline',
+        dest='pipeline',
+        action='store_true',
+        help='Read cvs output in a separate thread while parsing it, and '
+        'show with -v whether cvs or the parser is the bottleneck',
+    )
+    op.add_option(
+        '--rlog-file',
+        dest='rlog_file',
+        action='store',
+        help='Read saved cvs rlog output from PATH (- for stdin) instead '
+        'of running cvs',
+        metavar='PATH',
+    )
+    op.add_option(
+        '--cache-format',
+        dest='cache_format',
+        type='choice',
+        choices=['pickle', 'sqlite'],
+        default='pickle',
+        help='Store the cvs log cache as pickle files or in an SQLite '
+        'database (default: pickle)',
+        metavar='FORMAT',
+    )
+    op.add_option(
+        '--cache-margin',
+        dest='cache_margin',
+        action='store',
+        type='int',
+        default=0,
+        help='When updating the cvs log cache, read the log again from '
+        'this long before the latest cached commit',
+        metavar='seconds',
+    )
+    op.add_option(
+        '--skip-unchanged',
+        dest='skip_unchanged',
+        action='store_true',
+        help='When updating the cvs log cache, have cvs leave out files '
+        'without new revisions (needs cvs 1.12 or CVSNT on the server)',
+    )
+    op.add_option(
+        '--check-cache',
+        dest='check_cache',
+        action='store_true',
+        help='Check that changesets made from cached ones are the same as '
+        'those made from the whole log',
+    )
+    op.add_option(
+        '--columnar',
+        dest='columnar',
+        action='store_true',
+        help='Keep the log in a compact column store, for very large '
+        'repositories',
+    )
 
     options, args = op.parse_args()
 
@@ -1077,6 +2424,7 @@ def main():
         def nomessage(self, msg):
             pass
 
+        warn = message
         status = nomessage
         note = nomessage
         debug = nomessage
@@ -0,0 +1,167 @@
+# logstore.py - compact columnar storage for CVS log entries
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import array
+
+# logentry fields kept as ids into the table of distinct values
+_valuefields = ('author', 'branch', 'branches', 'branchpoints', 'comment',
+                'commitid', 'file', 'lines', 'mergepoint', 'parent', 'rcs',
+                'revision', 'tags')
+
+# logentry fields kept as bits of the flags column
+_flagfields = {'dead': 1, 'synthetic': 2}
+
+_allfields = sorted(_valuefields + tuple(_flagfields) + ('date',))
+
+class logrow(object):
+    '''View of one row of a logstore, with the attributes of a logentry.
+
+    Assigning to an attribute updates the store.
+    '''
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    @property
+    def date(self):
+        store = self._store
+        return store._seconds[self._row], store._offsets[self._row]
+
+    @date.setter
+    def date(self, value):
+        store = self._store
+        store._seconds[self._row], store._offsets[self._row] = value
+
+    def __repr__(self):
+        items = ("%s=%r" % (k, getattr(self, k)) for k in _allfields)
+        return "logentry(%s)" % ", ".join(items)
+
+def _valueproperty(name):
+    def get(self):
+        store = self._store
+        return store._values[store._columns[name][self._row]]
+    def set(self, value):
+        store = self._store
+        store._columns[name][self._row] = store._intern(value)
+    return property(get, set)
+
+def _flagproperty(bit):
+    def get(self):
+        return bool(self._store._flags[self._row] & bit)
+    def set(self, value):
+        flags = self._store._flags
+        if value:
+            flags[self._row] |= bit
+        else:
+            flags[self._row] &= ~bit
+    return property(get, set)
+
+for _name in _valuefields:
+    setattr(logrow, _name, _valueproperty(_name))
+for _name, _bit in _flagfields.items():
+    setattr(logrow, _name, _flagproperty(_bit))
+del _name, _bit
+
+class logstore(object):
+    '''List-like container of CVS log entries, stored by column.
+
+    Strings, revision tuples, tags and the other logentry fields that
+    repeat across entries are each stored once, and every row only
+    holds their ids; dates and flags are kept in arrays. Reading an
+    entry returns a logrow view, so a log of millions of revisions needs
+    a small fraction of the memory of a list of logentry objects.
+
+    Supports len(), iteration, indexing, append(), extend(), + and
+    sort(key=...), which is what createlog() and createchangeset() use.
+    Rows are not copied by sorting, so views stay valid.
+
+    >>> from types import SimpleNamespace as entry
+    >>> log = logstore([entry(file='b.c', date=(20, 0), dead=True)])
+    >>> log.append(entry(file='a.c', date=(10, 0)))
+    >>> log = [entry(file='c.c', date=(5, 0))] + log
+    >>> log += [entry(file='a.c', date=(30, 0))]
+    >>> first = log[0]
+    >>> log.sort(key=lambda e: e.date)
+    >>> [(e.file, e.date[0]) for e in log]
+    [('c.c', 5), ('a.c', 10), ('b.c', 20), ('a.c', 30)]
+    >>> [e.dead for e in log]
+    [False, False, True, False]
+    >>> first.file = 'd.c'
+    >>> len(log), log[0].file, log._values.count('a.c')
+    (4, 'd.c', 1)
+    '''
+    def __init__(self, entries=()):
+        self._values = [None]
+        self._ids = {None: 0}
+        self._columns = dict((k, array.array('i')) for k in _valuefields)
+        self._seconds = array.array('q')
+        self._offsets = array.array('i')
+        self._flags = array.array('B')
+        self._order = array.array('i')
+        self.extend(entries)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._ids = dict((v, i) for i, v in enumerate(self._values))
+
+    def _intern(self, value):
+        i = self._ids.get(value)
+        if i is None:
+            i = self._ids[value] = len(self._values)
+            self._values.append(value)
+        return i
+
+    def append(self, e):
+        '''Add a copy of the fields of logentry e'''
+        self._order.append(len(self._seconds))
+        for k in _valuefields:
+            self._columns[k].append(self._intern(getattr(e, k, None)))
+        seconds, offset = e.date
+        self._seconds.append(seconds)
+        self._offsets.append(offset)
+        flags = 0
+        for k, bit in _flagfields.items():
+            if getattr(e, k, False):
+                flags |= bit
+        self._flags.append(flags)
+
+    def extend(self, entries):
+        for e in entries:
+            self.append(e)
+
+    def sort(self, key):
+        self._order = array.array(
+            'i', sorted(self._order, key=lambda i: key(logrow(self, i))))
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, i):
+        return logrow(self, self._order[i])
+
+    def __iter__(self):
+        for i in self._order:
+            yield logrow(self, i)
+
+    def __add__(self, other):
+        store = logstore(self)
+        store.extend(other)
+        return store
+
+    def __radd__(self, other):
+        store = logstore(other)
+        store.extend(self)
+        return store
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
@@ -0,0 +1,232 @@
+# rcsfile.py - read the revision history of RCS ,v files
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import calendar
+import mmap
+import os
+import re
+
+class rcserror(Exception):
+    pass
+
+class delta(object):
+    '''Class delta has the following attributes:
+        .revision  - revision number as string
+        .date      - commit time in seconds since the epoch
+        .author    - author name
+        .state     - state of the revision, e.g. 'Exp' or 'dead'
+        .branches  - list of the first revisions of branches starting here
+        .next      - next revision in the delta chain or None
+        .commitid  - CVS commitid or None
+        .mergepoint - cvsnt mergepoint revision or None
+        .log       - commit message
+    '''
+    def __init__(self, revision):
+        self.revision = revision
+        self.date = None
+        self.author = None
+        self.state = None
+        self.branches = []
+        self.next = None
+        self.commitid = None
+        self.mergepoint = None
+        self.log = ''
+
+class rcsfile(object):
+    '''Class rcsfile has the following attributes:
+        .head      - head revision number as string
+        .symbols   - list of (name, revision) pairs, in file order
+        .deltas    - list of delta objects, in file order
+    '''
+    def __init__(self):
+        self.head = None
+        self.symbols = []
+        self.deltas = []
+
+_tokenre = re.compile(br'\s*(@|;|:|[^\s;:@]+)')
+
+class _lexer(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def token(self):
+        m = _tokenre.match(self.data, self.pos)
+        if not m:
+            return None
+        self.pos = m.end()
+        return m.group(1)
+
+    def peek(self):
+        m = _tokenre.match(self.data, self.pos)
+        if not m:
+            return None
+        return m.group(1)
+
+    def expect(self, word):
+        tok = self.token()
+        if tok != word:
+            raise rcserror('expected %r, found %r' % (word, tok))
+
+    def span(self):
+        '''Return the bounds of the string following the current position,
+        without unescaping it.'''
+        self.expect(b'@')
+        data = self.data
+        start = pos = self.pos
+        while True:
+            pos = data.find(b'@', pos)
+            if pos < 0:
+                raise rcserror('unterminated string')
+            if data[pos + 1:pos + 2] != b'@':
+                break
+            pos += 2
+        self.pos = pos + 1
+        return start, pos
+
+    def string(self):
+        start, end = self.span()
+        return self.data[start:end].replace(b'@@', b'@')
+
+    def phrase(self):
+        '''Read the values of a phrase up to and including its ';'.'''
+        values = []
+        while True:
+            tok = self.peek()
+            if tok is None:
+                raise rcserror('unexpected end of file')
+            if tok == b';':
+                self.token()
+                return values
+            if tok == b'@':
+                values.append(self.string())
+            else:
+                values.append(self.token())
+
+def _isnum(tok):
+    return tok is not None and tok[:1].isdigit()
+
+def _decode(s):
+    return s.decode('latin-1')
+
+def _date(s):
+    parts = [int(x) for x in s.split(b'.')]
+    if parts[0] < 100:
+        # RCS stores years before 2000 with two digits
+        parts[0] += 1900
+    return calendar.timegm(parts[:6] + [0, 0, 0])
+
+def parse(data):
+    '''Parse the contents of an RCS file.
+
+    Only the admin and delta sections are fully read. Of the deltatext
+    section only log messages are kept; revision texts are skipped
+    without being copied or decoded.
+
+    >>> f = parse(b"""head 1.2; access; symbols REL:1.1; locks; strict;
+    ... 1.2 date 2004.03.01.10.00.00; author bob; state Exp;
+    ... branches; next 1.1; commitid 10040430F0A2;
+    ... 1.1 date 99.12.31.23.59.59; author alice; state dead;
+    ... branches; next ;
+    ... desc @@
+    ... 1.2 log @fix @@ sign
+    ... @ text @b
+    ... @
+    ... 1.1 log @@ text @d1 1
+    ... a1 1
+    ... a
+    ... @""")
+    >>> f.head, f.symbols
+    ('1.2', [('REL', '1.1')])
+    >>> [(d.revision, d.date, d.author) for d in f.deltas]
+    [('1.2', 1078135200, 'bob'), ('1.1', 946684799, 'alice')]
+    >>> [(d.state, d.next) for d in f.deltas]
+    [('Exp', '1.1'), ('dead', None)]
+    >>> [(d.commitid, d.log) for d in f.deltas]
+    [('10040430F0A2', 'fix @ sign\\n'), (None, '')]
+    '''
+    lex = _lexer(data)
+    f = rcsfile()
+
+    # admin section
+    while True:
+        key = lex.token()
+        if key is None:
+            raise rcserror('unexpected end of file')
+        values = lex.phrase()
+        if key == b'head':
+            f.head = values and _decode(values[0]) or None
+        elif key == b'symbols':
+            for i in range(0, len(values) - 2, 3):
+                if values[i + 1] != b':':
+                    raise rcserror('bad symbol %r' % values[i])
+                f.symbols.append((_decode(values[i]), _decode(values[i + 2])))
+        tok = lex.peek()
+        if _isnum(tok) or tok == b'desc':
+            break
+
+    # delta section
+    deltas = {}
+    while _isnum(lex.peek()):
+        d = delta(_decode(lex.token()))
+        while True:
+            tok = lex.peek()
+            if tok is None or _isnum(tok) or tok == b'desc':
+                break
+            key = lex.token()
+            values = lex.phrase()
+            if key == b'date':
+                d.date = _date(values[0])
+            elif key == b'author':
+                d.author = _decode(values[0])
+            elif key == b'state':
+                d.state = values and _decode(values[0]) or ''
+            elif key == b'branches':
+                d.branches = [_decode(v) for v in values]
+            elif key == b'next':
+                d.next = values and _decode(values[0]) or None
+            elif key == b'commitid':
+                d.commitid = _decode(values[0])
+            elif key == b'mergepoint1':
+                d.mergepoint = _decode(values[0])
+        if d.date is None or d.author is None:
+            raise rcserror('incomplete delta %s' % d.revision)
+        deltas[d.revision] = d
+        f.deltas.append(d)
+
+    lex.expect(b'desc')
+    lex.span()
+
+    # deltatext section
+    while True:
+        tok = lex.token()
+        if tok is None:
+            break
+        d = deltas.get(_decode(tok))
+        if d is None:
+            raise rcserror('deltatext for unknown revision %r' % tok)
+        lex.expect(b'log')
+        d.log = _decode(lex.string())
+        while lex.peek() != b'text':
+            if lex.token() is None:
+                raise rcserror('unexpected end of file')
+            lex.phrase()
+        lex.token()
+        lex.span()
+
+    return f
+
+def read(path):
+    '''Read and parse the RCS file at path.
+
+    The file is mapped rather than read, so that the revision texts,
+    which make up most of it, are only looked at to find their ends.
+    '''
+    with open(path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            # empty files cannot be mapped
+            return parse(b'')
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse(data)
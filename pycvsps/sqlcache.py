@@ -0,0 +1,221 @@
+# sqlcache.py - SQLite storage for the CVS log cache
+#
+# This software may be used and distributed according to the terms of the
+# GNU General Public License version 2 or any later version.
+
+import sqlite3
+import urllib.request
+
+# change whenever the schema or the way fields are stored changes, so
+# that old caches are rebuilt
+_version = 3
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS entry (
+    id INTEGER PRIMARY KEY,
+    rcs TEXT NOT NULL,
+    file TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    tz INTEGER NOT NULL,
+    author TEXT,
+    branch TEXT,
+    comment TEXT,
+    commitid TEXT,
+    mergepoint TEXT,
+    dead INTEGER NOT NULL,
+    synthetic INTEGER NOT NULL,
+    added INTEGER,
+    removed INTEGER,
+    tags TEXT NOT NULL,
+    branches TEXT NOT NULL,
+    branchpoints TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stat (
+    rcs TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    ino INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS head (
+    file TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    revision TEXT NOT NULL,
+    PRIMARY KEY (file, branch)
+);
+'''
+
+# indexes of earlier versions; the whole log is always read in order,
+# so they only slowed down writing
+_oldindexes = ('entry_file', 'entry_date', 'entry_branch', 'entry_commitid')
+
+_columns = ('rcs', 'file', 'revision', 'parent', 'date', 'tz', 'author',
+            'branch', 'comment', 'commitid', 'mergepoint', 'dead',
+            'synthetic', 'added', 'removed', 'tags', 'branches',
+            'branchpoints')
+
+class cacheerror(Exception):
+    pass
+
+def _revstr(revision):
+    return '.'.join(map(str, revision))
+
+def _revtuple(s):
+    '''Return the revision tuple stored as s by _revstr()
+
+    >>> _revtuple(_revstr((1, 2, 4, 1)))
+    (1, 2, 4, 1)
+    >>> _revtuple(_revstr(()))
+    ()
+    '''
+    if not s:
+        return ()
+    return tuple(map(int, s.split('.')))
+
+def _row(e):
+    if e.lines is None:
+        added = removed = None
+    else:
+        added, removed = e.lines
+    return (e.rcs, e.file, _revstr(e.revision), _revstr(e.parent),
+            e.date[0], e.date[1], e.author, e.branch, e.comment,
+            e.commitid, e.mergepoint, int(e.dead), int(e.synthetic),
+            added, removed, '\n'.join(e.tags),
+            ' '.join(_revstr(b) for b in e.branches),
+            '\n'.join(sorted(e.branchpoints)))
+
+class logdb(object):
+    '''Log cache stored in an SQLite database at path.
+
+    Entries keep the order they were written in. Updates are done in
+    transactions, and the database is in WAL mode, so several processes
+    can read the cache while another one updates it.
+
+    Unless create is true, the database must already exist.
+
+    >>> import os, tempfile, types
+    >>> path = os.path.join(tempfile.mkdtemp(), 'log.sqlite')
+    >>> e = types.SimpleNamespace(
+    ...     rcs='/cvs/mod/a.c,v', file='a.c', revision=(1, 2), parent=(1, 1),
+    ...     date=(1000, 0), author='bob', branch=None, comment='fix',
+    ...     commitid=None, mergepoint=None, dead=False, synthetic=False,
+    ...     lines=(1, 0), tags=('REL',), branches=((1, 2, 2),),
+    ...     branchpoints=frozenset(['B']))
+    >>> db = logdb(path)
+    >>> db.write([e], {'/cvs/mod/a.c,v': (1, 2, 3)},
+    ...          {('a.c', (1,)): (1, 2)}, True)
+    >>> f, = db.read(types.SimpleNamespace)
+    >>> [f.revision, f.branches, f.tags, f.branchpoints] == [
+    ...     e.revision, e.branches, e.tags, e.branchpoints]
+    True
+    >>> db.versions(), db.stats()
+    ({('a.c', (1,)): (1, 2)}, {'/cvs/mod/a.c,v': (1, 2, 3)})
+    >>> db.close()
+    >>> import shutil
+    >>> shutil.rmtree(os.path.dirname(path))
+    '''
+    def __init__(self, path, create=True, timeout=60):
+        uri = 'file:%s?mode=%s' % (urllib.request.pathname2url(path),
+                                   create and 'rwc' or 'rw')
+        self.conn = sqlite3.connect(uri, uri=True, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.executescript(_schema)
+            self.conn.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                              ('version', _version))
+
+    def close(self):
+        self.conn.close()
+
+    def _checkversion(self):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                ('version',)).fetchone()
+        if row is None or row[0] != _version:
+            raise cacheerror('cache was written in an older format')
+
+    def read(self, make):
+        '''Return the cached log entries, built by calling make with the
+        fields of each entry as keyword arguments.
+
+        The whole log is read: grouping entries into changesets and
+        finding the parents of branches needs all of them, so loading
+        part of the cache is not supported.
+        '''
+        self._checkversion()
+        query = 'SELECT %s FROM entry ORDER BY id' % ', '.join(_columns)
+
+        # share equal strings, tuples and sets between entries
+        shared = {}
+        def share(x):
+            return shared.setdefault(x, x)
+
+        log = []
+        for (rcs, file, revision, parent, date, tz, author, branch,
+             comment, commitid, mergepoint, dead, synthetic, added, removed,
+             tags, branches, branchpoints) in self.conn.execute(query):
+            if added is None:
+                lines = None
+            else:
+                lines = (added, removed)
+            log.append(make(
+                rcs=share(rcs),
+                file=share(file),
+                revision=share(_revtuple(revision)),
+                parent=share(_revtuple(parent)),
+                date=(date, tz),
+                author=share(author),
+                branch=share(branch),
+                comment=share(comment),
+                commitid=commitid,
+                mergepoint=mergepoint,
+                dead=bool(dead),
+                synthetic=bool(synthetic),
+                lines=lines,
+                tags=share(tuple(tags.split('\n')) if tags else ()),
+                branches=share(tuple(_revtuple(b) for b in branches.split())),
+                branchpoints=share(frozenset(branchpoints.split('\n'))
+                                   if branchpoints else frozenset())))
+        return log
+
+    def stats(self):
+        '''Return the cached (mtime, size, inode) of each RCS file'''
+        self._checkversion()
+        return dict((rcs, (mtime, size, ino)) for rcs, mtime, size, ino
+                    in self.conn.execute('SELECT * FROM stat'))
+
+    def versions(self):
+        '''Return the latest cached revision of each (file, branch)'''
+        self._checkversion()
+        return dict(((file, _revtuple(branch)), _revtuple(revision))
+                    for file, branch, revision
+                    in self.conn.execute('SELECT * FROM head'))
+
+    def write(self, entries, stats, versions, replace):
+        '''Add entries after the cached ones, with the RCS file stats and
+        the latest revisions on branches that changed, or store them in
+        place of everything cached if replace is true'''
+        with self.conn:
+            if replace:
+                for name in _oldindexes:
+                    self.conn.execute('DROP INDEX IF EXISTS %s' % name)
+                self.conn.execute('DELETE FROM entry')
+                self.conn.execute('DELETE FROM stat')
+                self.conn.execute('DELETE FROM head')
+                self.conn.execute('UPDATE meta SET value = ? WHERE key = ?',
+                                  (_version, 'version'))
+            self.conn.executemany(
+                'INSERT INTO entry (%s) VALUES (%s)'
+                % (', '.join(_columns), ', '.join('?' * len(_columns))),
+                (_row(e) for e in entries))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO stat VALUES (?, ?, ?, ?)',
+                ((rcs,) + st for rcs, st in stats.items()))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO head VALUES (?, ?, ?)',
+                ((file, _revstr(branch), _revstr(revision))
+                 for (file, branch), revision in versions.items()))